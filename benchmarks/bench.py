@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+Benchmarks for dflat commands on synthetic objects.
+
+Each run generates an object from a scenario (how many files, how big,
+how deeply nested, how much of it changes in each version and how many
+versions there are), then times init, and checkout, status and commit for
+every version, followed by export, cat and verify. Every command runs in
+a forked child, so that its CPU time, peak RSS and I/O can be read apart
+from everything else, and the results are written as JSON that compare
+checks against an earlier run.
+
+    python benchmarks/bench.py run history --scale 0.1 -o before.json
+    python benchmarks/bench.py compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import optparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+import dflat
+
+j = os.path.join
+
+# the scenarios in the backlog: lots of small files, a few large ones, and
+# a long history; --scale shrinks or grows the number of files (or their
+# size, when there are few of them) and versions
+SCENARIOS = {
+    'small-files': {'files': 1000000, 'size': 4096, 'spread': 1.0,
+                    'depth': 4, 'fanout': 16, 'versions': 3, 'churn': 0.001},
+    'large-files': {'files': 10, 'size': 2**30, 'spread': 0.0,
+                    'depth': 1, 'fanout': 4, 'versions': 3, 'churn': 0.1},
+    'history': {'files': 2000, 'size': 16384, 'spread': 1.5,
+                'depth': 3, 'fanout': 8, 'versions': 500, 'churn': 0.01},
+}
+
+# metrics compared between runs, and whether they are summed over the
+# samples of a command or the largest sample is taken
+METRICS = {
+    'wall': sum, 'cpu_user': sum, 'cpu_system': sum, 'max_rss_kb': max,
+    'read_bytes': sum, 'write_bytes': sum, 'rchar': sum, 'wchar': sum,
+    'syscr': sum, 'syscw': sum,
+}
+
+# metrics that compare reports as regressions, with the smallest increase
+# that counts, so that noise in very quick commands is ignored
+REGRESSIONS = {
+    'wall': 0.01, 'cpu_user': 0.01, 'cpu_system': 0.01, 'max_rss_kb': 1024,
+    'read_bytes': 2**20, 'write_bytes': 2**20,
+}
+
+def main():
+    """Parse options and run or compare benchmarks."""
+    parser = optparse.OptionParser(usage='''
+       %prog run <scenario> [options]
+       %prog compare <old.json> <new.json> [options]
+
+scenarios: ''' + ', '.join(sorted(SCENARIOS)))
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='multiply the size of the scenario by this')
+    for name in ('files', 'size', 'depth', 'fanout', 'versions'):
+        parser.add_option('--' + name, type='int',
+                          help='override the scenario\'s %s' % name)
+    for name in ('spread', 'churn'):
+        parser.add_option('--' + name, type='float',
+                          help='override the scenario\'s %s' % name)
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help='workers passed to dflat commands')
+    parser.add_option('--index', action='store_true', default=False,
+                      help='benchmark a dflat with an index')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed for the layout of the generated object')
+    parser.add_option('--dir', help='where to generate the object')
+    parser.add_option('-o', '--output', help='write JSON results here')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='slowdown that compare reports as a regression')
+    opts, args = parser.parse_args()
+    if len(args) == 2 and args[0] == 'run' and args[1] in SCENARIOS:
+        scenario = scenario_params(args[1], opts)
+        results = run(scenario, workers=opts.workers, index=opts.index,
+                      seed=opts.seed, directory=opts.dir)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+    elif len(args) == 3 and args[0] == 'compare':
+        with open(args[1]) as f:
+            old = json.load(f)
+        with open(args[2]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, opts.threshold)
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.error('expected run <scenario> or compare <old> <new>')
+
+def scenario_params(scenario_name, opts):
+    """Return the parameters of a scenario, scaled and overridden."""
+    scenario = dict(SCENARIOS[scenario_name], name=scenario_name,
+                    scale=opts.scale)
+    if scenario['files'] >= 100:
+        scenario['files'] = max(1, int(scenario['files'] * opts.scale))
+    else:
+        scenario['size'] = max(1, int(scenario['size'] * opts.scale))
+    scenario['versions'] = max(1, int(scenario['versions'] * opts.scale))
+    for name in ('files', 'size', 'depth', 'fanout', 'versions', 'spread',
+                 'churn'):
+        if getattr(opts, name) is not None:
+            scenario[name] = getattr(opts, name)
+    return scenario
+
+def run(scenario, workers=1, index=False, seed=0, directory=None):
+    """
+    Generate an object for a scenario and time dflat commands on it,
+    returning the results as a dictionary.
+    """
+    rng = random.Random(seed)
+    tmp_dir = tempfile.mkdtemp(prefix='dflat-bench-', dir=directory)
+    home = j(tmp_dir, 'object')
+    samples = {}
+
+    def timed(command, func, *args, **kwargs):
+        samples.setdefault(command, []).append(
+            measure(func, *args, **kwargs))
+
+    try:
+        started = time.time()
+        files = generate(home, scenario, rng)
+        first_file = files[0]
+        generated = time.time() - started
+        timed('init', dflat.init, home, workers=workers, index=index)
+        for _ in range(scenario['versions']):
+            timed('checkout', dflat.checkout, home, workers=workers)
+            files = churn(j(home, dflat._latest_version(home), 'full'),
+                          files, scenario, rng)
+            timed('status', dflat.status, home, workers=workers)
+            timed('commit', dflat.commit, home, workers=workers)
+        # with nothing checked out status only reads the current version
+        timed('status-clean', dflat.status, home)
+        for version in sorted(set(['v001', dflat._current_version(home)])):
+            timed('export', dflat.export, home, version, workers=workers)
+            shutil.rmtree(j(home, 'export-%s' % version))
+            timed('export-tar', dflat.export, home, version,
+                  output=os.devnull, format='tar')
+        timed('cat', cat, home, 'v001', 'producer/%s' % first_file)
+        timed('verify', dflat.verify, home, workers=workers, resume=False)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        'scenario': scenario,
+        'workers': workers,
+        'index': index,
+        'seed': seed,
+        'generate_seconds': generated,
+        'dflat_version': dflat.DFLAT_VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commands': dict((command, summarize(s))
+                         for command, s in samples.items()),
+    }
+
+def generate(home, scenario, rng):
+    """
+    Create the files of a scenario under home, spread over a tree of the
+    given depth and fanout, with sizes drawn from a lognormal distribution
+    around the scenario's size. Returns the files' paths relative to home.
+    """
+    files = []
+    for i in range(scenario['files']):
+        files.append(new_file(home, i, scenario, rng))
+    return files
+
+def new_file(container, i, scenario, rng):
+    """Write the ith file of a scenario into a directory."""
+    parts = []
+    n = i
+    for _ in range(scenario['depth'] - 1):
+        parts.append('d%02i' % (n % scenario['fanout']))
+        n //= scenario['fanout']
+    filename = j(*(parts + ['f%07i.dat' % i]))
+    write_file(j(container, filename), file_size(scenario, rng))
+    return filename
+
+def file_size(scenario, rng):
+    """Draw the size of a file for a scenario."""
+    if not scenario['spread']:
+        return scenario['size']
+    return int(rng.lognormvariate(0, scenario['spread']) * scenario['size'])
+
+def write_file(path, size, offset=0):
+    """Write size random bytes into a file at offset, creating it."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        while size > 0:
+            chunk = min(size, dflat.BUFFER_SIZE)
+            f.write(os.urandom(chunk))
+            size -= chunk
+
+def churn(full_dir, files, scenario, rng):
+    """
+    Change a fraction of the files in a working version: half of the
+    changes rewrite part of a file, and the rest are split between new,
+    deleted and renamed files. Returns the files in the version.
+    """
+    count = max(1, int(len(files) * scenario['churn']))
+    files = list(files)
+    for _ in range(count // 2 or 1):
+        filename = rng.choice(files)
+        # replace rather than write in place, as editors usually do
+        path = j(full_dir, 'producer', filename)
+        size = os.path.getsize(path)
+        shutil.copyfile(path, path + '.new')
+        write_file(path + '.new', min(size, 4096) or 1,
+                   rng.randrange(size or 1))
+        os.rename(path + '.new', path)
+    for _ in range(count // 6):
+        files.append(new_file(j(full_dir, 'producer'),
+                              rng.randrange(10**7, 10**8), scenario, rng))
+    for _ in range(count // 6):
+        if len(files) > 1:
+            filename = files.pop(rng.randrange(len(files)))
+            os.remove(j(full_dir, 'producer', filename))
+    for _ in range(count // 6):
+        i = rng.randrange(len(files))
+        renamed = j(os.path.dirname(files[i]),
+                    'r' + os.path.basename(files[i]))
+        os.rename(j(full_dir, 'producer', files[i]),
+                  j(full_dir, 'producer', renamed))
+        files[i] = renamed
+    return files
+
+def cat(home, version, filename):
+    """Read a file as it was in a version, as dflat cat does."""
+    with dflat.open_at(home, version, filename) as f:
+        while f.read(dflat.BUFFER_SIZE):
+            pass
+
+def measure(func, *args, **kwargs):
+    """
+    Run a function in a forked child and return its wall time, CPU time,
+    peak RSS, I/O and read and write system calls. Bytes read and written
+    come from /proc/self/io where it exists: read_bytes and write_bytes
+    count storage I/O, and rchar and wchar everything read and written,
+    cached or not.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            dflat._QUIET = True
+            started = time.perf_counter()
+            func(*args, **kwargs)
+            result = {'wall': time.perf_counter() - started}
+            result.update(proc_io())
+        except BaseException as e:
+            result = {'error': repr(e)}
+            status = 1
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.load(f)
+    _, _, rusage = os.wait4(pid, 0)
+    if 'error' in result:
+        raise Exception("%s failed: %s" % (func.__name__, result['error']))
+    result['cpu_user'] = rusage.ru_utime
+    result['cpu_system'] = rusage.ru_stime
+    # kilobytes on linux, bytes on macos
+    result['max_rss_kb'] = rusage.ru_maxrss
+    if 'syscr' not in result:
+        result['syscr'] = rusage.ru_inblock
+        result['syscw'] = rusage.ru_oublock
+    return result
+
+def proc_io():
+    """Return this process's I/O counters from /proc/self/io, if there."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (IOError, OSError):
+        pass
+    return dict((name, counters[name]) for name in
+                ('read_bytes', 'write_bytes', 'rchar', 'wchar', 'syscr',
+                 'syscw') if name in counters)
+
+def summarize(samples):
+    """Combine the samples of a command into one set of metrics."""
+    summary = {'samples': len(samples)}
+    for metric, combine in METRICS.items():
+        values = [s[metric] for s in samples if metric in s]
+        if values:
+            summary[metric] = combine(values)
+    return summary
+
+def git_commit():
+    """Return the commit of the dflat being benchmarked, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(dflat.__file__))) \
+            .decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new, threshold=0.1):
+    """
+    Print how each metric of each command changed between two runs, and
+    return the (command, metric, ratio) of those that got worse by more
+    than threshold.
+    """
+    if old['scenario'] != new['scenario']:
+        print('warning: the runs used different scenarios')
+    regressions = []
+    for command in sorted(set(old['commands']) & set(new['commands'])):
+        for metric in sorted(METRICS):
+            before = old['commands'][command].get(metric)
+            after = new['commands'][command].get(metric)
+            if before is None or after is None:
+                continue
+            ratio = float(after) / before if before else \
+                (1.0 if not after else float('inf'))
+            flag = ''
+            if metric in REGRESSIONS and ratio > 1 + threshold and \
+                    after - before >= REGRESSIONS[metric]:
+                regressions.append((command, metric, ratio))
+                flag = '  REGRESSION'
+            print('%-14s %-12s %14.6g %14.6g %7.2fx%s' %
+                  (command, metric, before, after, ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,43 @@ DFLAT_VERSION = '0.16'
 DNATURAL_VERSION = '0.17'
 REDD_VERSION = '0.1'
 
+import io
 import os
 import re
 import sys
 import time
 import shutil
+import tarfile
+import zipfile
+import fcntl
+import errno
+import base64
+import signal
+import socket
 import hashlib
 import logging
 import namaste
 import os.path
+import json
+import mmap
+import ctypes
+import ctypes.util
+import select
+import sqlite3
+import zlib
+import bisect
+import collections
+import struct
+import fnmatch
 import datetime
 import optparse
-from functools import wraps
+import threading
+import traceback
+import contextlib
+import socketserver
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
 if sys.version_info.major >= 3:
     from urllib.parse import quote, unquote
 else:
@@ -28,61 +53,290 @@ j = os.path.join
 
 _QUIET = False
 
-def main():
-    """Parse options and dispatch to the appropriate method."""
+# commands that can be run on many Dflats at once with batch
+BATCH_COMMANDS = ('status', 'commit', 'checkout', 'export', 'verify')
+
+# the profile of the command running in each thread, and the listener
+# told about its progress by dflat.aio, see _Profile
+_PROFILING = threading.local()
+
+# callables that are given each command's profile, see add_profile_hook
+_PROFILE_HOOKS = []
+
+# where the command line run in each thread writes its output when dflatd
+# serves it, and whether it prints profiles (--profile)
+_OUTPUT = threading.local()
+
+# commands that bin/dflat has dflatd run when it is running
+DAEMON_COMMANDS = ('status', 'cat', 'get', 'export', 'log', 'find')
+
+# bytes of memory that parsed manifests, version lists and current versions
+# may take up in the cache, see set_cache_size
+CACHE_BYTES = 64 * 2**20
+
+# rough bytes of memory a cached manifest entry takes beyond its strings
+CACHE_ENTRY_BYTES = 200
+
+# format of the lines in log/dflat.log
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+
+# stacks of (file descriptor, exclusive) for the locks this process holds,
+# keyed by Dflat home and thread
+_LOCKS = {}
+
+# read files in large chunks when checksumming them
+BUFFER_SIZE = 0x100000
+
+# files modified this recently (in nanoseconds) are not added to the fixity
+# cache, since a later write could leave their mtime untouched
+RACY_WINDOW = 2 * 10**9
+
+# deletions per second that reap makes unless told otherwise, which can be
+# set for a Dflat with Reap-iops in dflat-info.txt
+REAP_IOPS = 1000
+
+# binary patches start with this line
+PATCH_MAGIC = b'DFLATPATCH1\n'
+
+# a patch is abandoned, and the whole file stored, if it would be larger
+# than this fraction of the file
+PATCH_RATIO = 0.5
+
+# seconds status waits for a watcher to catch up with its change journal
+JOURNAL_SYNC_TIMEOUT = 2
+
+# inotify events that may mean a file in a working version has changed
+# (linux/inotify.h)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# digest algorithms that can be used in manifests
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512', 'blake2b')
+
+# ioctl request number for cloning a file's extents (linux/fs.h)
+FICLONE = 0x40049409
+
+class LockedError(Exception):
+    """Raised when a Dflat stays locked for longer than a command waits."""
+
+def main(argv=None, cwd=None):
+    """
+    Parse options and dispatch to the appropriate method. dflatd passes the
+    arguments and working directory of the command line it is serving.
+    """
     parser = _option_parser()
-    _, args = parser.parse_args()
+    opts, args = parser.parse_args(argv)
+    _OUTPUT.profile = opts.profile
     try:
         cmd = args[0]
     except IndexError:
         parser.error('no command specified')
-    home = _dflat_home(os.getcwd())
+    cwd = cwd or os.getcwd()
+    home = _dflat_home(cwd)
+    output = opts.output
+    if output and output != '-':
+        output = j(cwd, output)
     try:
         version = args[1]
     except IndexError:
         # optional arg not passed
-        pass
+        version = None
+    try:
+        path = args[2]
+    except IndexError:
+        path = None
+
+    pool = {'workers': opts.workers, 'processes': opts.processes}
+    locking = {'wait': opts.wait, 'stale_after': opts.stale_after}
+    fixity = dict(pool, paranoid=opts.paranoid, **locking)
 
     if cmd == 'init':
-        init(os.getcwd())
+        init(cwd, algorithm=opts.algorithm or 'md5',
+             dedupe=opts.dedupe, patch_threshold=opts.patch_threshold,
+             detect_renames=opts.detect_renames,
+             index=opts.index, **locking, **pool)
+    elif cmd == 'batch':
+        if not opts.from_list:
+            parser.error('batch needs --from-list')
+        with open(j(cwd, opts.from_list)) as f:
+            homes = [line.strip() for line in f
+                     if line.strip() and not line.startswith('#')]
+        batch_opts = dict(locking)
+        if version in ('status', 'commit'):
+            batch_opts['paranoid'] = opts.paranoid
+        if version == 'verify':
+            batch_opts.update(rate=opts.rate, iops=opts.iops,
+                              resume=not opts.restart)
+        if version == 'export' and path:
+            batch_opts['version'] = path
+        for result in batch(version, homes, workers=opts.workers,
+                            per_device=opts.per_device, **batch_opts):
+            _stdout().write((json.dumps(result, sort_keys=True) +
+                             '\n').encode('utf-8'))
+            _stdout().flush()
     elif cmd == 'help':
         _print(parser.get_usage())
     elif not home:
         _print("not a dflat")
     elif cmd == 'checkout':
-        checkout(home)
+        checkout(home, clone=opts.clone, workers=opts.workers, **locking)
     elif cmd == 'commit':
-        commit(home)
+        commit(home, **fixity)
+        _reap_in_background(home, iops=opts.iops)
     elif cmd == 'status':
-        status(home)
+        status(home, **fixity)
     elif cmd == 'export':
-        export(home, version)
+        export(home, version, workers=opts.workers, output=output,
+               format=opts.format, **locking)
+    elif cmd == 'cat':
+        with open_at(home, version, path) as f:
+            shutil.copyfileobj(f, _stdout(), BUFFER_SIZE)
+    elif cmd == 'get':
+        get(home, version, path, dest=output or cwd,
+            workers=opts.workers, **locking)
+    elif cmd == 'verify':
+        verify(home, workers=opts.workers, rate=opts.rate, iops=opts.iops,
+               resume=not opts.restart, **locking)
+    elif cmd == 'migrate':
+        if not opts.algorithm:
+            parser.error('migrate needs --algorithm')
+        migrate(home, opts.algorithm, workers=opts.workers, **locking)
+    elif cmd == 'gc':
+        gc(home, **locking)
+    elif cmd == 'watch':
+        watch(home)
+    elif cmd == 'recover':
+        recover(home, **locking)
+    elif cmd == 'reap':
+        reap(home, iops=opts.iops)
+    elif cmd == 'index':
+        index(home, **locking)
+    elif cmd == 'log':
+        if not version:
+            parser.error('log needs a path')
+        history(home, version, **locking)
+    elif cmd == 'find':
+        if not opts.digest:
+            parser.error('find needs --digest')
+        find(home, opts.digest, **locking)
+    elif cmd == 'compact':
+        compact(home, interval=opts.keyframe_interval,
+                max_bytes=opts.keyframe_bytes, workers=opts.workers,
+                **locking)
+        _reap_in_background(home, iops=opts.iops)
     else:
         _print("unknown command: %s" % cmd)
 
 def lock(func):
-    """Decorator for commands to obtain and release lock."""
+    """
+    Decorator for commands to obtain and release an exclusive lock. The
+    decorated command accepts a wait keyword giving the number of seconds
+    to wait for the lock before giving up, and a stale_after keyword giving
+    the age in seconds at which a lock.txt is taken to have been left
+    behind, see _get_lock. A commit that was interrupted
+    is recovered before the command runs.
+    """
     @wraps(func)
     def new_f(home, *args, **opts):
-        _get_lock(home, func)
-        result = func(home, *args, **opts)
-        _release_lock(home)
-        return result
+        with _phase('lock'):
+            _get_lock(home, func, wait=opts.pop('wait', 0),
+                      stale_after=opts.pop('stale_after', None))
+        try:
+            _recover(home)
+            return func(home, *args, **opts)
+        finally:
+            _release_lock(home)
+    return new_f
+
+def shared_lock(func):
+    """
+    Decorator for read-only commands to obtain and release a shared lock,
+    which any number of readers may hold at once but which excludes the
+    holder of an exclusive lock.
+    """
+    @wraps(func)
+    def new_f(home, *args, **opts):
+        with _phase('lock'):
+            _get_lock(home, func, shared=True, wait=opts.pop('wait', 0),
+                      stale_after=opts.pop('stale_after', None))
+        try:
+            # no writer holds the lock, so its journal is left from a crash
+            if os.path.isfile(_commit_journal(home)):
+                raise Exception("a commit was interrupted, run dflat recover")
+            return func(home, *args, **opts)
+        finally:
+            _release_lock(home)
     return new_f
 
 def log(func):
-    """Decorator to log to the Dflat home log."""
+    """
+    Decorator to log to the Dflat home log. The command is profiled, and
+    its profile is logged as a JSON record when it finishes.
+    """
     @wraps(func)
     def new_f(home, *args, **opts):
         log_file = j(home, 'log', 'dflat.log')
         _configure_logger(log_file)
-        result = func(home, *args, **opts)
+        if getattr(_PROFILING, 'profile', None) is not None:
+            # commands called by commands are part of their profile
+            return func(home, *args, **opts)
+        profile = _PROFILING.profile = _Profile(
+            func.__name__, home, getattr(_PROFILING, 'listener', None))
+        try:
+            result = func(home, *args, **opts)
+        finally:
+            _PROFILING.profile = None
+            _finish_profile(profile)
         return result
     return new_f
 
+def add_profile_hook(hook):
+    """
+    Call hook with the profile of every command that finishes from now on:
+    a dictionary with the command, the Dflat home, the seconds and CPU
+    seconds it took, and the seconds and calls of each phase and the value
+    of each counter. Phases run on worker threads add up their seconds, so
+    they can take longer than the command.
+    """
+    _PROFILE_HOOKS.append(hook)
+
+def remove_profile_hook(hook):
+    """Stop calling a hook added with add_profile_hook."""
+    _PROFILE_HOOKS.remove(hook)
+
+def __getattr__(name):
+    """Load dflat.aio, the asyncio versions of the commands, when used."""
+    if name == 'aio':
+        import dflat_aio
+        return dflat_aio
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 @lock
-def init(home):
-    """Convert a directory into a Dflat directory."""
+def init(home, workers=1, processes=False, algorithm='md5', dedupe=False,
+         patch_threshold=None, index=False, detect_renames=False):
+    """
+    Convert a directory into a Dflat directory, whose manifests use the
+    given digest algorithm. If dedupe is set the contents of deltas are
+    deduplicated by hardlinking them into a content store in objects/. If
+    patch_threshold is set, deltas store modified files of at least that
+    many bytes as binary patches against their newer versions. If index is
+    set, a SQLite index of versions and files is kept in index.sqlite. If
+    detect_renames is set, deltas record renamed files in rename.txt rather
+    than storing them again, which plain ReDD readers don't understand.
+    """
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise Exception("unknown digest algorithm: %s" % algorithm)
     contents = [x for x in os.listdir(home) if x != 'lock.txt']
     info = open(j(home, 'dflat-info.txt'), 'w')
     namaste.dirtype(home, 'dflat_%s' % DFLAT_VERSION, verbose=False)
@@ -92,6 +346,15 @@ def init(home):
     info.write(_anvl('Delta-scheme', 'ReDD/%s' % REDD_VERSION))
     info.write(_anvl('Current-scheme', 'file'))
     info.write(_anvl('Class-scheme', 'CLOP/0.3'))
+    info.write(_anvl('Digest-algorithm', algorithm))
+    if dedupe:
+        info.write(_anvl('Content-store', 'objects'))
+    if patch_threshold:
+        info.write(_anvl('Patch-threshold', patch_threshold))
+    if index:
+        info.write(_anvl('Index', 'index.sqlite'))
+    if detect_renames:
+        info.write(_anvl('Rename-detection', 'yes'))
     info.close()
     os.mkdir(j(home, 'log'))
     version = _new_version(home)
@@ -100,7 +363,9 @@ def init(home):
     for filename in contents:
         os.rename(j(home, filename),
                   j(home, version, 'full', 'producer', filename))
-    _update_manifest(j(home, version))
+    _update_manifest(j(home, version), workers=workers, processes=processes)
+    if index:
+        _build_index(home, _index_file(home)).close()
 
     # can't use decorator since the log directory doesn't exist when
     # init is called
@@ -110,128 +375,1794 @@ def init(home):
 
 @log
 @lock
-def checkout(home):
-    """Check out a new version of the Dflat."""
+def checkout(home, clone='copy', workers=1):
+    """
+    Check out a new version of the Dflat.
+
+    The clone argument controls how files in the current version are
+    duplicated: 'copy' copies their contents, and 'reflink' shares extents
+    with the current version where the filesystem supports it, copying
+    them where it doesn't. Files are copied on a pool of worker threads
+    when workers > 1.
+    """
+    if clone not in ('copy', 'reflink'):
+        raise Exception("unknown clone method: %s" % clone)
     current_version = _current_version(home)
     new_version = _next_version(home)
     if os.path.isdir(j(home, new_version)):
         _print("%s already checked out" % new_version)
         return new_version
-    _copy_tree(j(home, current_version), j(home, new_version))
-    logging.info('checked out new version %s', new_version)
+    os.mkdir(j(home, new_version))
+    shutil.copystat(j(home, current_version), j(home, new_version))
+    shutil.copy2(j(home, current_version, 'manifest.txt'),
+                 j(home, new_version, 'manifest.txt'))
+    copied = _copy_tree(j(home, current_version, 'full'),
+                        j(home, new_version, 'full'), clone=clone,
+                        workers=workers)
+    # the clone has the same contents as the current version, so its
+    # digests can be reused without reading anything
+    _seed_fixity_cache(home, current_version, new_version)
+    logging.info('checked out new version %s, %s', new_version,
+                 _copy_rate(copied))
     _print("checked out %s" % new_version)
     return new_version
 
 @log
 @lock
-def commit(home): #, msg=None):
+def commit(home, workers=1, processes=False, paranoid=False): #, msg=None):
     """Commit a modified version to the Dflat."""
     current_version = _current_version(home)
     modified_version = _latest_version(home)
     if current_version == modified_version:
         _print("nothing to commit")
         return
-    _update_manifest(j(home, modified_version))
+    _update_manifest(j(home, modified_version), workers=workers,
+                     processes=processes, paranoid=paranoid, journal=True)
     delta = _delta(home, current_version, modified_version)
-    if not _has_changes(delta):
+
+    # nothing is moved until the journal of everything the commit will do
+    # is complete, so an interrupted commit can always be rolled back or
+    # forward, see recover
+    redd_home = j(home, current_version, 'delta')
+    journal = open(_commit_journal(home), 'w')
+    _journal_entry(journal, {'current': current_version,
+                             'modified': modified_version})
+    # the header has to be on disk before anything it rolls back is made
+    journal.flush()
+    os.fsync(journal.fileno())
+    os.mkdir(redd_home)
+    namaste.dirtype(redd_home, 'redd_%s' % REDD_VERSION, verbose=False)
+
+    # stream the delta, planning to move the old copies of deleted and
+    # modified files into the delta, and listing added and modified files
+    # for deletion and renamed files for moving back
+    algorithm = _algorithm(home)
+    delete = open(j(redd_home, 'delete.txt'), 'w')
+    rename = None
+    patch_threshold = _patch_threshold(home)
+    pending_bytes = 0
+    with _phase('commit.plan'):
+        for kind, old_entry, new_entry in delta.entries():
+            filename = (new_entry or old_entry)[0]
+            if kind == 'renamed':
+                # the old copy is left behind in full/ like a patched file
+                if rename is None:
+                    rename = open(j(redd_home, 'rename.txt'), 'w')
+                rename.write("%s %s\n" % (quote(new_entry[0]),
+                                          quote(old_entry[0])))
+                continue
+            if kind in ('added', 'modified'):
+                delete.write("%s\n" % quote(filename))
+            old_file = j(home, current_version, 'full', filename)
+            patch_file = j(redd_home, 'patch', filename)
+            if kind == 'modified' and patch_threshold and \
+                    os.path.getsize(old_file) >= patch_threshold and \
+                    _make_patch(old_file,
+                                j(home, modified_version, 'full', filename),
+                                patch_file):
+                # the old copy is left behind in full/, which goes away
+                # unless this version becomes a keyframe
+                pending_bytes += os.path.getsize(patch_file)
+                _journal_entry(journal, ['file', j('patch', filename),
+                                         algorithm,
+                                         _digest(patch_file, algorithm)])
+                continue
+            if kind in ('deleted', 'modified'):
+                # the manifest already has the digest of the old copy
+                pending_bytes += os.path.getsize(old_file)
+                _journal_entry(journal, ['move', filename, old_entry[1],
+                                         old_entry[2]])
+    delete.close()
+    if rename is not None:
+        rename.close()
+    counts = delta.counts()
+    if not any(counts.values()):
+        journal.close()
+        shutil.rmtree(redd_home)
+        os.remove(_commit_journal(home))
+        _print("no changes")
+        return
+    for filename in sorted(os.listdir(redd_home)):
+        if os.path.isfile(j(redd_home, filename)):
+            _journal_entry(journal, ['file', filename, algorithm,
+                                     _digest(j(redd_home, filename),
+                                             algorithm)])
+    _journal_entry(journal, ['planned', _keyframe_due(home, current_version,
+                                                      pending_bytes)])
+    journal.flush()
+    os.fsync(journal.fileno())
+    journal.close()
+
+    _commit_forward(home)
+
+    for kind in counts:
+        _count('commit.%s' % kind, counts[kind])
+    logging.info('committed %s %s', modified_version, counts)
+    _print("committed %s" % modified_version)
+
+    return delta
+
+@log
+def recover(home, wait=0, stale_after=None):
+    """
+    Finish or undo a commit that was interrupted, using the journal it
+    left in log/commit.jsonl. A commit that had planned everything it was
+    going to do is rolled forward, and one that hadn't is rolled back.
+    Returns 'forward', 'back', or None if there was nothing to recover.
+    Commands that take the exclusive lock recover automatically.
+    """
+    _get_lock(home, recover, wait=wait, stale_after=stale_after)
+    try:
+        return _recover(home)
+    finally:
+        _release_lock(home)
+
+def _commit_journal(home):
+    """Return the path of the journal of a commit in progress."""
+    return j(home, 'log', 'commit.jsonl')
+
+def _journal_entry(journal, entry):
+    """Write an entry to a commit journal as a line of JSON."""
+    journal.write(json.dumps(entry) + '\n')
+
+def _read_commit_journal(home):
+    """
+    Read a commit journal, returning its header, its entries and whether
+    the commit had planned everything, with the keyframe decision if so.
+    A partly written last line is ignored.
+    """
+    header = None
+    entries = []
+    planned = None
+    with open(_commit_journal(home)) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if header is None:
+                header = entry
+            elif entry[0] == 'planned':
+                planned = entry
+            else:
+                entries.append(entry)
+    return header, entries, planned
+
+def _recover(home):
+    """Roll an interrupted commit forward or back, if there is one."""
+    if not os.path.isfile(_commit_journal(home)):
+        return None
+    header, _, planned = _read_commit_journal(home)
+    if planned:
+        logging.warning('rolling forward interrupted commit of %s',
+                        header['modified'])
+        _commit_forward(home)
+        _print("rolled forward commit of %s" % header['modified'])
+        return 'forward'
+    # nothing outside the new delta directory was touched yet, and the
+    # current version never has a delta otherwise
+    redd_home = j(home, _current_version(home), 'delta')
+    if os.path.isdir(redd_home):
+        shutil.rmtree(redd_home)
+    modified = header['modified'] if header else _latest_version(home)
+    logging.warning('rolled back interrupted commit of %s', modified)
+    _print("rolled back commit of %s" % modified)
+    os.remove(_commit_journal(home))
+    return 'back'
+
+def _commit_forward(home):
+    """
+    Carry out a planned commit from its journal. Every step can be
+    repeated, so this also finishes a commit that was interrupted part
+    way through. The d-manifest is written from the digests in the
+    journal rather than by reading the delta again.
+    """
+    header, entries, planned = _read_commit_journal(home)
+    current_version = header['current']
+    modified_version = header['modified']
+    keyframe = planned[1]
+    redd_home = j(home, current_version, 'delta')
+    dedupe = _content_store(home)
+    d_manifest = []
+    with _phase('commit.store'):
+        for entry in entries:
+            if entry[0] == 'file':
+                d_manifest.append(tuple(entry[1:]))
+                continue
+            _, filename, algorithm, digest = entry
+            src = j(home, current_version, 'full', filename)
+            dest = j(redd_home, 'add', filename)
+            if not os.path.exists(dest):
+                # os.renames would prune the emptied directories of src,
+                # which a keyframe links the file back into
+                dest_dir = os.path.dirname(dest)
+                if not os.path.isdir(dest_dir):
+                    os.makedirs(dest_dir)
+                os.rename(src, dest)
+                if dedupe:
+                    _store_blob(home, algorithm, digest, dest)
+            if keyframe and not os.path.exists(src):
+                # keep the retired version materialized, so that exports
+                # of older versions don't have to replay every delta since
+                # the current one
+                _link_file(dest, src)
+            d_manifest.append((j('add', filename), algorithm, digest))
+    full_dir = j(home, current_version, 'full')
+    if not keyframe and os.path.isdir(full_dir):
+        with _phase('commit.trash'):
+            _trash(home, full_dir)
+    _remove_fixity_cache(j(home, current_version))
+    _set_current(home, modified_version)
+
+    d_manifest_file = j(home, current_version, 'd-manifest.txt')
+    tmp_file = _tmp_name(d_manifest_file)
+    with open(tmp_file, 'w') as f:
+        for filename, algorithm, digest in sorted(d_manifest):
+            f.write("%s %s %s\n" % (quote(filename), algorithm, digest))
+    os.rename(tmp_file, d_manifest_file)
+    with _phase('commit.index'):
+        _update_index(home, current_version, modified_version)
+    os.remove(_commit_journal(home))
+
+@log
+def reap(home, iops=None):
+    """
+    Delete the directories that commands moved into the trash of a Dflat,
+    making at most iops deletions a second, and return the number of files
+    and directories deleted. iops defaults to the Reap-iops of the Dflat,
+    or REAP_IOPS, and 0 deletes as fast as possible. Nothing refers to the
+    trash, so reap needs no lock, and a reap that is interrupted is
+    finished by the next one.
+    """
+    trash_dir = j(home, 'trash')
+    if iops is None:
+        iops = _reap_iops(home)
+    throttle = _Throttle(iops=iops)
+    reaped = 0
+    if not os.path.isdir(trash_dir):
+        return reaped
+    for entry in sorted(os.listdir(trash_dir)):
+        for dirpath, dirnames, filenames in os.walk(j(trash_dir, entry),
+                                                    topdown=False):
+            for name in filenames + dirnames:
+                reaped += _reap_one(j(dirpath, name), throttle)
+        reaped += _reap_one(j(trash_dir, entry), throttle)
+    logging.info('reaped %i files and directories', reaped)
+    _print("reaped %i files and directories" % reaped)
+    return reaped
+
+def _reap_iops(home):
+    """Return the deletions per second reap makes by default."""
+    iops = dict(_info(home)).get('Reap-iops')
+    return float(iops) if iops else REAP_IOPS
+
+def _reap_one(path, throttle):
+    """
+    Delete a file or empty directory from the trash, returning 1, or 0 if
+    another reaper got to it first.
+    """
+    throttle(0)
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.rmdir(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+    return 1
+
+def _trash(home, directory):
+    """
+    Move a directory that is no longer needed into the trash of a Dflat,
+    where reap deletes it later. Renaming it is atomic and takes the same
+    time however many files it holds.
+    """
+    trash_dir = j(home, 'trash')
+    if not os.path.isdir(trash_dir):
+        os.mkdir(trash_dir)
+    version = os.path.basename(os.path.dirname(directory))
+    name = '%s-%s.%i-%i' % (version, os.path.basename(directory),
+                            os.getpid(), int(time.time() * 1e6))
+    os.rename(directory, j(trash_dir, name))
+
+def _reap_in_background(home, iops=None):
+    """
+    Start a detached process that reaps the trash of a Dflat, so that the
+    command that filled it can return straight away.
+    """
+    if not os.path.isdir(j(home, 'trash')):
+        return
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        # fork again so the reaper is not left as a child of the caller
+        os.setsid()
+        if os.fork() == 0:
+            global _QUIET
+            _QUIET = True
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            reap(home, iops=iops)
+    finally:
+        os._exit(0)
+
+@log
+@lock
+def gc(home):
+    """
+    Remove blobs from the content store that no delta refers to any more,
+    returning the number of blobs and bytes reclaimed.
+    """
+    reclaimed = {'blobs': 0, 'bytes': 0}
+    objects_dir = j(home, 'objects')
+    if not os.path.isdir(objects_dir):
+        return reclaimed
+    for dirpath, _, filenames in os.walk(objects_dir, topdown=False):
+        for filename in filenames:
+            blob = j(dirpath, filename)
+            st = os.lstat(blob)
+            # deltas refer to blobs by hardlinking them
+            if st.st_nlink == 1:
+                os.remove(blob)
+                reclaimed['blobs'] += 1
+                reclaimed['bytes'] += st.st_size
+        if dirpath != objects_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    logging.info('gc reclaimed %i blobs (%i bytes)', reclaimed['blobs'],
+                 reclaimed['bytes'])
+    _print("reclaimed %i blobs (%i bytes)" % (reclaimed['blobs'],
+                                              reclaimed['bytes']))
+    return reclaimed
+
+@log
+@lock
+def compact(home, interval=None, max_bytes=None, workers=1):
+    """
+    Add or remove keyframes, versions older than the current one that keep
+    a materialized full directory alongside their delta, so that they match
+    the keyframe policy in dflat-info.txt.
+
+    A version is a keyframe when its number is a multiple of interval, or
+    when the deltas accumulated since the previous keyframe hold at least
+    max_bytes. Passing either argument records it as the new policy, and
+    passing 0 removes it.
+    """
+    if interval is not None:
+        _set_info(home, 'Keyframe-interval', interval or None)
+    if max_bytes is not None:
+        _set_info(home, 'Keyframe-bytes', max_bytes or None)
+    interval, max_bytes = _keyframe_policy(home)
+    current_version = _current_version(home)
+    older_versions = _versions(home, from_version=current_version)[:-1]
+
+    keyframes = set()
+    accumulated = 0
+    for version in older_versions:
+        accumulated += _delta_size(home, version)
+        if (interval and _version_number(version) % interval == 0) or \
+                (max_bytes and accumulated >= max_bytes):
+            keyframes.add(version)
+            accumulated = 0
+
+    # materialize newest first so each keyframe can be built from the last
+    for version in reversed(older_versions):
+        if version in keyframes and not _is_keyframe(home, version):
+            plan = _export_plan(home, version)
+            tmp_dir = j(home, version, 'full.tmp')
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            _copy_files(((_source_path(home, src), j(tmp_dir, f))
+                         for f, src in sorted(plan.items())),
+                        clone='reflink', workers=workers, make_dirs=True)
+            os.rename(tmp_dir, j(home, version, 'full'))
+            logging.info('added keyframe %s', version)
+            _print("added keyframe %s" % version)
+    for version in older_versions:
+        if version not in keyframes and _is_keyframe(home, version) and \
+                os.path.isdir(j(home, version, 'delta')):
+            _trash(home, j(home, version, 'full'))
+            logging.info('removed keyframe %s', version)
+            _print("removed keyframe %s" % version)
+    if _index_file(home):
+        _build_index(home, _index_file(home)).close()
+    return sorted(keyframes)
+
+def batch(command, homes, workers=4, per_device=1, **opts):
+    """
+    Run a command (status, commit, checkout, export or verify) on many
+    Dflats at once using a pool of worker processes, running at most
+    per_device commands at a time against Dflats on the same device. Any
+    other keyword arguments are passed to the command, with wait defaulting
+    to 60 seconds so that each Dflat's lock is waited for. A dictionary
+    describing the outcome is yielded for each Dflat as it finishes.
+    """
+    if command not in BATCH_COMMANDS:
+        raise Exception("unknown batch command: %s" % command)
+    opts.setdefault('wait', 60)
+    queues = {}
+    for home in homes:
+        try:
+            device = os.stat(home).st_dev
+        except OSError as e:
+            yield {'home': home, 'command': command, 'ok': False,
+                   'error': str(e)}
+            continue
+        queues.setdefault(device, []).append(home)
+    for queue in queues.values():
+        queue.reverse()
+    running = dict((device, 0) for device in queues)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        while pending or any(queues.values()):
+            # fill free workers from devices that have capacity to spare
+            for device, queue in queues.items():
+                while queue and running[device] < per_device and \
+                        len(pending) < (workers or os.cpu_count() or 1):
+                    home = queue.pop()
+                    future = executor.submit(_batch_one, command, home, opts)
+                    pending[future] = (device, home)
+                    running[device] += 1
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                device, home = pending.pop(future)
+                running[device] -= 1
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield {'home': home, 'command': command, 'ok': False,
+                           'error': str(e)}
+
+def _batch_one(command, home, opts):
+    """Run a batch command on one Dflat in a worker process."""
+    global _QUIET
+    _QUIET = True
+    result = {'home': home, 'command': command, 'ok': True}
+    commands = {'status': status, 'commit': commit, 'checkout': checkout,
+                'export': export, 'verify': verify}
+    try:
+        home = _dflat_home(home) or home
+        opts = dict(opts)
+        if command == 'export':
+            version = opts.pop('version', None) or _current_version(home)
+            result['version'] = version
+            export(home, version, **opts)
+        else:
+            outcome = commands[command](home, **opts)
+            if isinstance(outcome, Delta):
+                outcome = outcome.counts()
+            result['result'] = outcome
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = str(e)
+    return result
+
+@log
+@shared_lock
+def export(home, version, workers=1, output=None, format=None):
+    """
+    Export the specified version of the Dflat into an export-vNNN directory,
+    or, when a format of 'tar' or 'zip' is given, stream an archive of it
+    to output: a path, a binary file object, or '-' for standard output.
+    """
+    _check_version(home, version)
+    export_version = 'export-%s' % version
+    plan = _export_plan(home, version)
+    if format:
+        with _phase('export.archive'):
+            archived = _export_archive(home, version, plan, output or '-',
+                                       format)
+        logging.info('exported version %s as %s, %i files (%i bytes)',
+                     version, format, archived['files'], archived['bytes'])
+        return
+    if not os.path.isdir(j(home, export_version, 'full')):
+        os.makedirs(j(home, export_version, 'full'))
+    shutil.copy2(j(home, version, 'manifest.txt'),
+                 j(home, export_version, 'manifest.txt'))
+    # each file is copied once, straight from wherever its bytes live
+    copied = _copy_files(((_source_path(home, src),
+                           j(home, export_version, 'full', f))
+                          for f, src in sorted(plan.items())),
+                         workers=workers, make_dirs=True)
+    logging.info('exported version %s, %s', version, _copy_rate(copied))
+
+def _export_archive(home, version, plan, output, format):
+    """
+    Write a tar or zip archive of a version of the Dflat to output, reading
+    each file from wherever its bytes live in the plan. The archive is laid
+    out like an export-vNNN directory.
+    """
+    if format not in ('tar', 'zip'):
+        raise Exception("unknown export format: %s" % format)
+    export_version = 'export-%s' % version
+    members = [(j(home, version, 'manifest.txt'),
+                j(export_version, 'manifest.txt'))]
+    members.extend((_source_path(home, src), j(export_version, 'full', f))
+                   for f, src in sorted(plan.items()))
+    archived = {'files': 0, 'bytes': 0}
+    if output == '-':
+        out = _stdout()
+    elif isinstance(output, str):
+        out = open(output, 'wb')
+    else:
+        out = output
+    try:
+        if format == 'tar':
+            # a stream, rather than a file, so output needn't be seekable
+            with tarfile.open(fileobj=out, mode='w|') as archive:
+                for src, arcname in members:
+                    with _open_source(src) as f:
+                        if isinstance(src, tuple):
+                            info = tarfile.TarInfo(arcname)
+                            info.size = f.seek(0, io.SEEK_END)
+                            info.mtime = os.path.getmtime(src[0])
+                            f.seek(0)
+                        else:
+                            info = archive.gettarinfo(src, arcname)
+                        archive.addfile(info, f)
+                    archived['files'] += 1
+                    archived['bytes'] += info.size
+        else:
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for src, arcname in members:
+                    if isinstance(src, tuple):
+                        with _open_source(src) as f:
+                            with archive.open(arcname, 'w') as dest:
+                                shutil.copyfileobj(f, dest, BUFFER_SIZE)
+                                archived['bytes'] += f.tell()
+                    else:
+                        archive.write(src, arcname)
+                        archived['bytes'] += os.path.getsize(src)
+                    archived['files'] += 1
+    finally:
+        if out is not output and out is not _stdout():
+            out.close()
+        else:
+            out.flush()
+    return archived
+
+def open_at(home, version, filename):
+    """
+    Open a file as it was in the specified version of the Dflat for reading
+    in binary mode, without exporting the rest of the version.
+    """
+    _check_version(home, version)
+    plan = _export_plan(home, version, match=lambda f: f == filename)
+    if filename not in plan:
+        raise Exception("%s not found in %s" % (filename, version))
+    return _open_source(_source_path(home, plan[filename]))
+
+@log
+@shared_lock
+def get(home, version, pattern, dest=os.curdir, workers=1):
+    """
+    Copy the files matching a glob pattern, as they were in the specified
+    version of the Dflat, into the dest directory. Returns the list of
+    files that were copied.
+    """
+    _check_version(home, version)
+    plan = _export_plan(home, version,
+                        match=lambda f: fnmatch.fnmatchcase(f, pattern))
+    filenames = sorted(plan)
+    copied = _copy_files(((_source_path(home, plan[f]), j(dest, f))
+                          for f in filenames),
+                         workers=workers, make_dirs=True)
+    logging.info('got %s %s into %s, %s', version, pattern, dest,
+                 _copy_rate(copied))
+    for filename in filenames:
+        _print(filename)
+    return filenames
+
+@log
+@lock
+def index(home):
+    """
+    Build the Dflat's SQLite index from scratch, adding one if it hasn't
+    got one, and return the number of versions and files indexed.
+    """
+    if not _index_file(home):
+        _set_info(home, 'Index', 'index.sqlite')
+    db = _build_index(home, _index_file(home))
+    try:
+        counts = {
+            'versions': db.execute("SELECT COUNT(*) FROM versions")
+                          .fetchone()[0],
+            'files': db.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+        }
+    finally:
+        db.close()
+    logging.info('indexed %(versions)i versions, %(files)i files', counts)
+    _print("indexed %(versions)i versions, %(files)i files" % counts)
+    return counts
+
+@shared_lock
+def history(home, filename):
+    """
+    Print and return (version, size, algorithm, digest) tuples for each
+    committed version that contains a file, oldest first. Without an index
+    one is built in memory for the query.
+    """
+    db = _index(home) or _build_index(home, ':memory:')
+    try:
+        rows = db.execute("""SELECT f.version, f.size, f.algorithm, f.digest
+                             FROM files f JOIN versions v
+                             ON f.version = v.version WHERE f.path = ?
+                             ORDER BY v.number""", (filename,)).fetchall()
+    finally:
+        db.close()
+    previous = None
+    for version, size, algorithm, digest in rows:
+        change = 'added' if previous is None else \
+            'modified' if previous != digest else 'unchanged'
+        _print("%s %s %s %s %s" % (version, change, size, algorithm, digest))
+        previous = digest
+    return rows
+
+@shared_lock
+def find(home, digest):
+    """
+    Print and return (version, filename, source) tuples for each file in a
+    committed version with the given digest, where source is where its
+    contents can be read from as in an export plan. Without an index one is
+    built in memory for the query.
+    """
+    db = _index(home) or _build_index(home, ':memory:')
+    try:
+        rows = db.execute("""SELECT f.version, f.path, f.algorithm, f.digest,
+                                    f.location
+                             FROM files f JOIN versions v
+                             ON f.version = v.version WHERE f.digest = ?
+                             ORDER BY v.number, f.path""",
+                          (digest,)).fetchall()
+        found = [(row[0], row[1], _index_source(db, *row)) for row in rows]
+    finally:
+        db.close()
+    for version, filename, source in found:
+        if isinstance(source, tuple):
+            source = source[0]
+        _print("%s %s %s" % (version, filename, source))
+    return found
+
+@log
+def watch(home, timeout=None):
+    """
+    Keep a change journal for the working version of the Dflat, recording
+    the paths that inotify reports created, modified or deleted in it, so
+    that status and commit only have to look at those. When the working
+    version is committed or a new one is checked out the journal moves on
+    to it. Runs until interrupted, or for timeout seconds.
+    """
+    watcher = _Watcher(home)
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        while deadline is None or time.time() < deadline:
+            wait = 1 if deadline is None else \
+                max(0, min(1, deadline - time.time()))
+            ready, _, _ = select.select([watcher.fd], [], [], wait)
+            if ready:
+                watcher.read()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def serve(socket_path=None):
+    """
+    Run dflatd: serve the command lines that bin/dflat sends to a Unix
+    socket, keeping the cache of parsed manifests, version lists and Dflat
+    homes warm between them, so that quick commands don't pay for starting
+    Python and reading everything again. Runs until interrupted or
+    terminated.
+    """
+    socket_path = socket_path or _daemon_socket()
+    server = _daemon(socket_path)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def _daemon_socket():
+    """Return the path of the socket dflatd listens on."""
+    return os.environ.get('DFLATD_SOCKET') or \
+        j(os.environ.get('XDG_RUNTIME_DIR') or '/tmp',
+          'dflatd-%i.sock' % os.getuid())
+
+def _daemon(socket_path):
+    """Start the dflatd server on a socket, and its caches and log."""
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(socket_path)
+            raise Exception("dflatd is already running on %s" % socket_path)
+        except socket.error:
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    umask = os.umask(0o077)
+    try:
+        server = _DaemonServer(socket_path, _DaemonHandler)
+    finally:
+        os.umask(umask)
+    root = logging.getLogger()
+    if not any(isinstance(h, _DaemonLog) for h in root.handlers):
+        root.addHandler(_DaemonLog())
+        root.setLevel(logging.INFO)
+    return server
+
+def _check_version(home, version):
+    """Raise an exception unless the version exists in the Dflat."""
+    versions = _versions(home)
+    if version not in versions:
+        raise Exception("version %s not found in %s" %
+                        (version, ", ".join(versions)))
+
+def _export_plan(home, version, match=None):
+    """
+    Work out where the bytes of each file in a version of the Dflat live.
+    Returns a dictionary mapping each filename to the path of the file,
+    relative to the Dflat home, that holds its contents in that version.
+    Files stored as binary patches map to a (patch, base) tuple instead,
+    where base is where the newer version the patch applies to lives. If
+    match is given, only filenames for which it returns True are planned.
+
+    Starting with the manifest of the nearest keyframe at or after the
+    requested version (at worst the current version), the ReDD deltas are
+    walked back to the requested version, reading only their delete.txt
+    files and d-manifests.
+    """
+    if match is None:
+        match = lambda filename: True
+    current_version = _current_version(home)
+    if _version_number(version) > _version_number(current_version):
+        # an uncommitted working version holds all its own files
+        return dict((f, j(version, 'full', f))
+                    for f in _manifest_files(j(home, version, 'full'))
+                    if match(f))
+    db = _index(home)
+    if db is not None:
+        try:
+            return _index_plan(db, version, match)
+        finally:
+            db.close()
+    keyframe = current_version
+    for candidate in _versions(home, from_version=current_version,
+                               to_version=version):
+        if _is_keyframe(home, candidate):
+            keyframe = candidate
+            break
+    delta_versions = _versions(home,
+                               reverse=True,
+                               from_version=keyframe,
+                               to_version=version)[1:]
+    renames = dict((delta, dict(_delta_renames(home, delta)))
+                   for delta in delta_versions)
+
+    def wanted(filename, deltas):
+        """
+        Should a file named filename before the given deltas are replayed
+        be planned? Renames are followed so that match sees the name the
+        file has in the requested version.
+        """
+        for delta in deltas:
+            filename = renames[delta].get(filename, filename)
+        return match(filename)
+
+    renaming = [delta for delta in delta_versions if renames[delta]]
+    plan = dict((f, j(keyframe, 'full', f))
+                for f, _, _ in _manifest_entries(home, keyframe)
+                if wanted(f, renaming))
+    for delta in delta_versions:
+        # from here on, only renames in older deltas apply
+        if delta in renaming:
+            renaming.remove(delta)
+        _replay_delta(home, delta, plan, renames[delta],
+                      lambda f: wanted(f, renaming))
+    return plan
+
+def _replay_delta(home, delta, plan, renames, match):
+    """
+    Turn an export plan for the version after delta into one for delta, by
+    applying its deletes, adds, patches and the renames given as a
+    dictionary of new to old filenames. Only files for which match returns
+    True are added to the plan.
+    """
+    _count('plan.deltas')
+    with _phase('plan.replay'):
+        # patches and renames refer to files in the newer version, so find
+        # them before deleting anything
+        patches = [(f, plan.get(f)) for f in _delta_adds(home, delta, 'patch')
+                   if match(f)]
+        moves = [(old, plan.pop(new, None)) for new, old in renames.items()]
+        moves = [(old, source) for old, source in moves if match(old)]
+        for filename in _delta_deletes(home, delta):
+            plan.pop(filename, None)
+        for filename in _delta_adds(home, delta):
+            if match(filename):
+                plan[filename] = j(delta, 'delta', 'add', filename)
+        for filename, base in patches:
+            if base is None:
+                raise Exception("no base for patch %s in %s" %
+                                (filename, delta))
+            plan[filename] = (j(delta, 'delta', 'patch', filename), base)
+        for filename, source in moves:
+            if source is None:
+                raise Exception("no source for renamed %s in %s" %
+                                (filename, delta))
+            plan[filename] = source
+
+def _source_path(home, source):
+    """Make a source from an export plan absolute."""
+    if isinstance(source, tuple):
+        return (j(home, source[0]), _source_path(home, source[1]))
+    return j(home, source)
+
+def _open_source(source):
+    """
+    Open an absolute source from an export plan for reading in binary mode,
+    applying patches on the fly as it is read.
+    """
+    if isinstance(source, tuple):
+        patch, base = source
+        return io.BufferedReader(_PatchReader(patch, _open_source(base)),
+                                 BUFFER_SIZE)
+    return open(source, 'rb')
+
+def _content_store(home):
+    """Is the Dflat deduplicating its deltas with a content store?"""
+    return dict(_info(home)).get('Content-store') == 'objects'
+
+def _blob_path(home, algorithm, digest):
+    """Return the path of a blob in the content store."""
+    return j(home, 'objects', algorithm, digest[:2], digest)
+
+def _store_blob(home, algorithm, digest, filename):
+    """
+    Deduplicate a file that has been moved into a delta against the content
+    store. If a blob with the same digest is already stored the file is
+    replaced by a hardlink to it, otherwise the file becomes the blob. The
+    file is left as it is if it can't be linked.
+    """
+    blob = _blob_path(home, algorithm, digest)
+    try:
+        if os.path.isfile(blob):
+            tmp_file = _tmp_name(filename)
+            os.link(blob, tmp_file)
+            os.rename(tmp_file, filename)
+        else:
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            os.link(filename, blob)
+    except OSError as e:
+        logging.warning("not deduplicating %s: %s", filename, e)
+
+def _patch_threshold(home):
+    """
+    Return the size from which modified files are stored as binary
+    patches, or None if the Dflat doesn't use patches.
+    """
+    threshold = dict(_info(home)).get('Patch-threshold')
+    return int(threshold) if threshold else None
+
+def _detect_renames(home):
+    """Does the Dflat record renamed files in rename.txt?"""
+    return dict(_info(home)).get('Rename-detection') == 'yes'
+
+def _is_keyframe(home, version):
+    """Does this version of the Dflat have a materialized full directory?"""
+    return os.path.isdir(j(home, version, 'full'))
+
+def _keyframe_policy(home):
+    """
+    Return the keyframe interval and accumulated delta byte threshold
+    recorded in dflat-info.txt, either of which may be None.
+    """
+    info = dict(_info(home))
+    interval = info.get('Keyframe-interval')
+    max_bytes = info.get('Keyframe-bytes')
+    return (int(interval) if interval else None,
+            int(max_bytes) if max_bytes else None)
+
+def _keyframe_due(home, version, pending_bytes=0):
+    """
+    Should a version that is being retired by a commit stay full? The
+    commit is going to store pending_bytes in its delta.
+    """
+    interval, max_bytes = _keyframe_policy(home)
+    if interval and _version_number(version) % interval == 0:
+        return True
+    if max_bytes:
+        accumulated = pending_bytes
+        for older in _versions(home, reverse=True, from_version=version):
+            if older != version and _is_keyframe(home, older):
+                break
+            accumulated += _delta_size(home, older)
+        return accumulated >= max_bytes
+    return False
+
+def _delta_size(home, version):
+    """
+    Return the bytes a version's delta stores, in whole files and patches,
+    which is what the keyframe byte threshold counts.
+    """
+    return _tree_size(j(home, version, 'delta', 'add')) + \
+        _tree_size(j(home, version, 'delta', 'patch'))
+
+def _tree_size(directory):
+    """Return the total size of the files in a directory tree."""
+    size = 0
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        if not os.path.isdir(path):
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+def _delta_deletes(home, version):
+    """Return the files listed in the delete.txt of a ReDD delta."""
+    delete_file = j(home, version, 'delta', 'delete.txt')
+    if not os.path.isfile(delete_file):
+        return []
+    with open(delete_file) as f:
+        return [unquote(line) for line in f.read().split()]
+
+def _delta_renames(home, version):
+    """
+    Return (new filename, old filename) pairs for the files listed in the
+    rename.txt of a delta, which were renamed without being changed.
+    """
+    rename_file = j(home, version, 'delta', 'rename.txt')
+    if not os.path.isfile(rename_file):
+        return []
+    with open(rename_file) as f:
+        return [tuple(unquote(name) for name in line.split())
+                for line in f if line.strip()]
+
+def _delta_adds(home, version, subdir='add'):
+    """
+    Return the files, relative to the full directory, held in the add (or
+    patch) directory of a ReDD delta, using its d-manifest when there is
+    one.
+    """
+    add_dir = j(home, version, 'delta', subdir)
+    d_manifest = j(home, version, 'd-manifest.txt')
+    if not os.path.isdir(add_dir):
+        return []
+    if not os.path.isfile(d_manifest):
+        return list(_manifest_files(add_dir))
+    adds = []
+    with open(d_manifest) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            filename = unquote(line.split()[0])
+            if filename.startswith(subdir + '/'):
+                adds.append(filename[len(subdir) + 1:])
+    return adds
+
+def _index_file(home):
+    """Return the path of the Dflat's index, or None if it hasn't got one."""
+    name = dict(_info(home)).get('Index')
+    return j(home, name) if name else None
+
+def _index(home):
+    """
+    Open the Dflat's SQLite index, rebuilding it if it is missing or wasn't
+    updated by the last commit. Returns None if the Dflat has no index.
+    """
+    index_file = _index_file(home)
+    if index_file is None:
+        return None
+    if os.path.isfile(index_file):
+        db = sqlite3.connect(index_file)
+        if _indexed_version(db) == _current_version(home):
+            return db
+        db.close()
+    _build_index(home, index_file).close()
+    return sqlite3.connect(index_file)
+
+def _indexed_version(db):
+    """Return the version that was current when the index was updated."""
+    row = db.execute("SELECT version FROM versions WHERE current = 1") \
+        .fetchone()
+    return row[0] if row else None
+
+def _build_index(home, index_file):
+    """
+    Build an index of every committed version of the Dflat from its
+    manifests and deltas, replacing index_file (which may be ':memory:')
+    atomically. Returns a connection to the new index.
+
+    The versions table has a row for each version, and the files table
+    has a row for each file in each version, giving its size, digest and,
+    if the version stores the file itself, its location relative to the
+    Dflat home. Files a version shares with the version after it have no
+    location, and are found by their digest.
+    """
+    if index_file == ':memory:':
+        tmp_file = index_file
+    else:
+        tmp_file = _tmp_name(index_file)
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+    db = sqlite3.connect(tmp_file)
+    db.executescript("""
+        CREATE TABLE versions (version TEXT PRIMARY KEY, number INTEGER,
+                               current INTEGER, keyframe INTEGER);
+        CREATE TABLE files (version TEXT, path TEXT, size INTEGER,
+                            algorithm TEXT, digest TEXT, location TEXT,
+                            PRIMARY KEY (version, path));
+        CREATE INDEX files_path ON files (path);
+        CREATE INDEX files_digest ON files (digest, algorithm);
+    """)
+    current_version = _current_version(home)
+    plan = {}
+    with db:
+        for version in _versions(home, reverse=True,
+                                 from_version=current_version):
+            keyframe = _is_keyframe(home, version)
+            if version == current_version:
+                plan = dict((f, j(version, 'full', f)) for f, _, _ in
+                            _manifest_entries(home, version))
+            else:
+                _replay_delta(home, version, plan,
+                              dict(_delta_renames(home, version)),
+                              lambda f: True)
+                if keyframe:
+                    plan = dict((f, j(version, 'full', f)) for f in plan)
+            db.execute("INSERT INTO versions VALUES (?, ?, ?, ?)",
+                       (version, _version_number(version),
+                        version == current_version,
+                        keyframe and version != current_version))
+            db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                           _index_rows(home, version, plan))
+        # sizes of files a version shares with a newer one
+        db.execute("""UPDATE files SET size =
+                          (SELECT s.size FROM files s
+                           WHERE s.digest = files.digest
+                           AND s.algorithm = files.algorithm
+                           AND s.size IS NOT NULL LIMIT 1)
+                      WHERE size IS NULL""")
+    if tmp_file != index_file:
+        db.close()
+        os.rename(tmp_file, index_file)
+        db = sqlite3.connect(index_file)
+    return db
+
+def _index_rows(home, version, plan):
+    """
+    Generate rows of the files table for a version from its manifest,
+    given its export plan (which is rebuilt as a plan for version alone
+    when plan is None).
+    """
+    if plan is None:
+        plan = dict((f, j(version, 'full', f)) for f, _, _ in
+                    _manifest_entries(home, version))
+    for filename, algorithm, digest in _manifest_entries(home, version):
+        source = plan.get(filename)
+        stored = source[0] if isinstance(source, tuple) else source
+        if stored is None or not stored.startswith(version + os.sep):
+            yield version, filename, None, algorithm, digest, None
+            continue
+        if isinstance(source, tuple):
+            # only the target of a patch knows its size
+            with _PatchReader(j(home, stored), io.BytesIO()) as patch:
+                size = patch.size
+        else:
+            size = os.path.getsize(j(home, stored))
+        yield version, filename, size, algorithm, digest, stored
+
+def _update_index(home, retired_version, current_version):
+    """
+    Bring the index up to date after a commit retired a version, or
+    rebuild it if it had fallen behind.
+    """
+    index_file = _index_file(home)
+    if index_file is None:
+        return
+    db = None
+    if os.path.isfile(index_file):
+        db = sqlite3.connect(index_file)
+        if _indexed_version(db) != retired_version:
+            db.close()
+            db = None
+    if db is None:
+        _build_index(home, index_file).close()
+        return
+    keyframe = _is_keyframe(home, retired_version)
+    with db:
+        db.execute("UPDATE versions SET current = 0")
+        db.execute("UPDATE versions SET keyframe = ? WHERE version = ?",
+                   (keyframe, retired_version))
+        db.execute("INSERT INTO versions VALUES (?, ?, 1, 0)",
+                   (current_version, _version_number(current_version)))
+        db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                       _index_rows(home, current_version, None))
+        if not keyframe:
+            db.execute("UPDATE files SET location = NULL WHERE version = ?",
+                       (retired_version,))
+            db.executemany("""UPDATE files SET location = ?
+                              WHERE version = ? AND path = ?""",
+                           [(j(retired_version, 'delta', kind, f),
+                             retired_version, f)
+                            for kind in ('add', 'patch')
+                            for f in _delta_adds(home, retired_version,
+                                                 kind)])
+    db.close()
+
+def _index_plan(db, version, match):
+    """Work out an export plan for a version from the index."""
+    plan = {}
+    rows = db.execute("""SELECT path, algorithm, digest, location FROM files
+                         WHERE version = ?""", (version,)).fetchall()
+    if not rows and db.execute("SELECT 1 FROM versions WHERE version = ?",
+                               (version,)).fetchone() is None:
+        raise Exception("%s is not in the index" % version)
+    for filename, algorithm, digest, location in rows:
+        if match(filename):
+            plan[filename] = _index_source(db, version, filename, algorithm,
+                                           digest, location)
+    return plan
+
+def _index_source(db, version, filename, algorithm, digest, location):
+    """
+    Return the source of a file in an export plan from its row in the
+    index. Files without a location are read from any stored copy with the
+    same digest, or failing that from the same file in the next version
+    (whose digest differs when the Dflat was migrated to another
+    algorithm), and patches are applied to the file in the next version.
+    """
+    if location is None:
+        row = db.execute("""SELECT location FROM files
+                            WHERE digest = ? AND algorithm = ?
+                            AND location IS NOT NULL
+                            AND location NOT LIKE '%/delta/patch/%'
+                            LIMIT 1""", (digest, algorithm)).fetchone()
+        if row:
+            return row[0]
+        row = db.execute("""SELECT version, path, location FROM files
+                            WHERE digest = ? AND algorithm = ?
+                            AND location IS NOT NULL LIMIT 1""",
+                         (digest, algorithm)).fetchone()
+        if row is None:
+            row = _index_next(db, version, filename)
+            if row is None or row[2] == algorithm and row[3] != digest:
+                raise Exception("no copy of %s in %s" % (filename, version))
+            return _index_source(db, *row)
+        version, filename, location = row
+    if '/delta/patch/' not in location:
+        return location
+    row = _index_next(db, version, filename)
+    if row is None:
+        raise Exception("no base for patch %s in %s" % (filename, version))
+    return (location, _index_source(db, *row))
+
+def _index_next(db, version, filename):
+    """
+    Return the row of the index for a file in the version after the given
+    one, or None if it isn't there.
+    """
+    return db.execute("""SELECT version, path, algorithm, digest, location
+                         FROM files WHERE path = ? AND version =
+                             (SELECT version FROM versions WHERE number >
+                                 (SELECT number FROM versions
+                                  WHERE version = ?)
+                              ORDER BY number LIMIT 1)""",
+                      (filename, version)).fetchone()
+
+def _index_entries(db, version):
+    """
+    Generate (filename, algorithm, digest) tuples for a version from the
+    index in filename order.
+    """
+    try:
+        for row in db.execute("""SELECT path, algorithm, digest FROM files
+                                 WHERE version = ? ORDER BY path""",
+                              (version,)):
+            yield row
+    finally:
+        db.close()
+
+def _journal_file(version_dir, suffix='txt'):
+    """Return the path of the change journal for a working version."""
+    version_dir = os.path.abspath(version_dir)
+    return j(os.path.dirname(version_dir), 'cache',
+             'journal-%s.%s' % (os.path.basename(version_dir), suffix))
+
+def _journal_sync(version_dir):
+    """
+    Wait for a live watcher to journal everything that has happened in a
+    working version so far. Returns None if there is no live watcher, and
+    otherwise a (journal id, offset, changes) tuple, where offset is how far
+    into the journal the version is now accounted for and changes is the
+    set of paths journaled since the manifest was last updated, or None if
+    that isn't known and the version has to be scanned.
+    """
+    journal_file = _journal_file(version_dir)
+    try:
+        with open(journal_file, 'rb') as f:
+            header = f.readline().decode('utf-8').split()
+    except (IOError, OSError):
+        return None
+    # the watcher writes "# dflat-watch host pid id" when it starts
+    if len(header) != 5 or header[1] != 'dflat-watch' or \
+            header[2] != socket.gethostname() or \
+            not _pid_alive(int(header[3])):
+        return None
+    journal_id = header[4]
+    position = _journal_position(version_dir, journal_id)
+
+    # inotify reports events in order, so once the watcher has journaled
+    # the sync file everything before it has been journaled too
+    token = '%i-%i-%i' % (os.getpid(), threading.get_ident(),
+                          time.time_ns())
+    sync_file = _journal_file(version_dir, 'sync-%s' % token)
+    open(sync_file, 'w').close()
+    marker = ('# sync %s\n' % token).encode('utf-8')
+    start = position or 0
+    deadline = time.time() + JOURNAL_SYNC_TIMEOUT
+    while True:
+        try:
+            with open(journal_file, 'rb') as f:
+                f.seek(start)
+                journal = f.read()
+        except (IOError, OSError):
+            # the watcher stopped
+            journal = b''
+            deadline = 0
+        end = journal.find(marker)
+        if end != -1:
+            break
+        if time.time() >= deadline:
+            if os.path.isfile(sync_file):
+                os.remove(sync_file)
+            return None
+        time.sleep(0.01)
+    offset = start + end + len(marker)
+    if position is None:
+        return journal_id, offset, None
+    changes = set()
+    for line in journal[:end].decode('utf-8').splitlines():
+        if line == '# overflow':
+            return journal_id, offset, None
+        if not line.startswith('#'):
+            changes.add(unquote(line))
+    return journal_id, offset, changes
+
+def _journal_position(version_dir, journal_id):
+    """
+    Return how far into the journal with the given id the manifest of a
+    working version accounts for, or None if it doesn't account for it.
+    """
+    try:
+        with open(_journal_file(version_dir, 'pos')) as f:
+            cols = f.read().split()
+    except (IOError, OSError):
+        return None
+    if len(cols) != 2 or cols[0] != journal_id:
+        return None
+    return int(cols[1])
+
+def _journal_consumed(version_dir, journaled):
+    """Record how far into its journal a working version's manifest goes."""
+    pos_file = _journal_file(version_dir, 'pos')
+    tmp_file = _tmp_name(pos_file)
+    with open(tmp_file, 'w') as f:
+        f.write("%s %i\n" % journaled[:2])
+    os.rename(tmp_file, pos_file)
+
+def _journal_unchanged(manifest_file, changes, algorithm):
+    """
+    Return a dictionary mapping the files in a manifest that aren't at or
+    under any of the changed paths to their digests.
+    """
+    unchanged = {}
+    version_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for filename, file_algorithm, digest in _manifest_entries(
+            *os.path.split(version_dir)):
+        if file_algorithm == algorithm and \
+                not _journaled(filename, changes):
+            unchanged[filename] = digest
+    return unchanged
+
+def _journaled(filename, changes):
+    """Is a file, or a directory it is in, among the changed paths?"""
+    while filename:
+        if filename in changes:
+            return True
+        filename = os.path.dirname(filename)
+    return False
+
+def _journal_files(container_dir, changes):
+    """Generate the files that are now at or under the changed paths."""
+    for path in changes:
+        if os.path.isfile(j(container_dir, path)):
+            if os.path.basename(path) not in ('manifest.txt', 'lock.txt'):
+                yield path
+        elif os.path.isdir(j(container_dir, path)):
+            for filename in _manifest_files(j(container_dir, path)):
+                yield j(path, filename)
+
+@log
+@shared_lock
+def status(home, workers=1, processes=False, paranoid=False):
+    """Print current status of the Dflat."""
+    _print("dflat home: %s" % home)
+    current_version = _current_version(home)
+    _print("current version: %s" % current_version)
+    latest_version = _latest_version(home)
+    _print("working version: %s" % latest_version)
+    if current_version == latest_version:
         _print("no changes")
+        delta = None
+    else:
+        _update_manifest(j(home, latest_version), workers=workers,
+                         processes=processes, paranoid=paranoid, journal=True)
+        delta = _delta(home, current_version, latest_version)
+        # one pass over the delta, printing each kind of change in turn
+        changes = dict((kind, []) for kind in Delta.kinds)
+        for kind, old_entry, new_entry in delta.entries():
+            if kind == 'renamed':
+                changes[kind].append("%s -> %s" % (old_entry[0],
+                                                   new_entry[0]))
+            else:
+                changes[kind].append((new_entry or old_entry)[0])
+        for kind in ('added', 'modified', 'deleted', 'renamed'):
+            _print_delta_files(kind, changes[kind])
+    return delta
+
+@log
+def verify(home, workers=1, rate=None, iops=None, resume=True, wait=60,
+           stale_after=None):
+    """
+    Audit the fixity of the Dflat by checksumming the full and delta
+    directories of every committed version against their manifests.
+    Returns a dictionary listing the files that are mismatched, missing
+    or extra, and the number of files verified.
+
+    Reads are throttled to rate megabytes and iops reads per second when
+    given. Progress is checkpointed in log/verify.json, and an interrupted
+    audit picks up where it left off unless resume is False. A shared lock
+    is held, waiting up to wait seconds for it, while each directory is
+    verified.
+    """
+    checkpoint_file = j(home, 'log', 'verify.json')
+    checkpoint = None
+    if resume and os.path.isfile(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        logging.info('resuming verify from %s %s', checkpoint['unit'],
+                     checkpoint['position'])
+    if checkpoint is None:
+        checkpoint = {'done': [], 'unit': None, 'position': None,
+                      'verified': 0, 'mismatched': [], 'missing': [],
+                      'extra': []}
+    throttle = _Throttle(rate, iops)
+    checksum = partial(_digest, throttle=throttle)
+    if not workers:
+        workers = os.cpu_count() or 1
+    saved = time.time()
+
+    current_version = _current_version(home)
+    units = []
+    for version in _versions(home, from_version=current_version):
+        if os.path.isdir(j(home, version, 'full')):
+            units.append((version, 'full', 'manifest.txt'))
+        if os.path.isdir(j(home, version, 'delta')):
+            units.append((version, 'delta', 'd-manifest.txt'))
+
+    for version, container, manifest in units:
+        unit = '%s/%s' % (version, container)
+        if unit in checkpoint['done']:
+            continue
+        position = None
+        if checkpoint['unit'] == unit:
+            position = checkpoint['position']
+        checkpoint['unit'] = unit
+        # hold a shared lock for one unit at a time, so that commits can
+        # get in between the parts of a long audit
+        _get_lock(home, verify, shared=True, wait=wait,
+                  stale_after=stale_after)
+        try:
+            container_dir = j(home, version, container)
+            entries = _sorted_manifest_entries(home, version, manifest)
+            listed = set()
+            batch = []
+            for entry in entries:
+                filename = entry[0]
+                listed.add(filename)
+                if position is not None and filename <= position:
+                    continue
+                batch.append(entry)
+                if len(batch) >= workers * 8:
+                    _verify_batch(container_dir, unit, batch, checksum,
+                                  workers, checkpoint)
+                    batch = []
+                    if time.time() - saved > 5:
+                        _save_checkpoint(checkpoint_file, checkpoint)
+                        saved = time.time()
+            _verify_batch(container_dir, unit, batch, checksum, workers,
+                          checkpoint)
+            for filename in _manifest_files(container_dir):
+                if filename not in listed:
+                    checkpoint['extra'].append('%s/%s' % (unit, filename))
+                    _print("extra: %s/%s" % (unit, filename))
+        finally:
+            _release_lock(home)
+        checkpoint['done'].append(unit)
+        checkpoint['unit'] = checkpoint['position'] = None
+        _save_checkpoint(checkpoint_file, checkpoint)
+
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    report = dict((k, checkpoint[k])
+                  for k in ('verified', 'mismatched', 'missing', 'extra'))
+    logging.info('verified %i files: %i mismatched, %i missing, %i extra',
+                 report['verified'], len(report['mismatched']),
+                 len(report['missing']), len(report['extra']))
+    _print("verified %i files" % report['verified'])
+    return report
+
+def _verify_batch(container_dir, unit, batch, checksum, workers, checkpoint):
+    """
+    Checksum a batch of (filename, algorithm, digest) manifest entries in
+    parallel and record the results, and how far the audit got, in the
+    checkpoint.
+    """
+    if not batch:
         return
 
-    redd_home = j(home, current_version, 'delta')
-    os.mkdir(redd_home)
-    namaste.dirtype(redd_home, 'redd_%s' % REDD_VERSION, verbose=False)
+    def check(entry):
+        try:
+            return checksum(j(container_dir, entry[0]), entry[1])
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    for (filename, _, digest), actual in zip(batch,
+                                             _map(check, batch, workers)):
+        path = '%s/%s' % (unit, filename)
+        if actual is None:
+            checkpoint['missing'].append(path)
+            _print("missing: %s" % path)
+        elif actual != digest:
+            checkpoint['mismatched'].append(path)
+            _print("mismatched: %s" % path)
+        checkpoint['verified'] += 1
+    checkpoint['position'] = batch[-1][0]
+
+def _save_checkpoint(checkpoint_file, checkpoint):
+    """Atomically save the progress of a verify."""
+    tmp_file = _tmp_name(checkpoint_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(tmp_file, checkpoint_file)
+
+@log
+@lock
+def migrate(home, algorithm, workers=1):
+    """
+    Rewrite the manifests of every full and delta directory in the Dflat to
+    use another digest algorithm, and record it in dflat-info.txt so new
+    manifests use it too. Each file is read once, computing its old digest
+    to check it alongside the new one; files whose old digest doesn't match
+    keep their old manifest line and are returned. Manifests of versions
+    without a full directory are left alone, since Checkm lets algorithms
+    vary from line to line.
+    """
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise Exception("unknown digest algorithm: %s" % algorithm)
+    if not workers:
+        workers = os.cpu_count() or 1
+    current_version = _current_version(home)
+    mismatched = []
+    migrated = 0
+    for version in _versions(home, from_version=current_version):
+        for container, manifest in (('full', 'manifest.txt'),
+                                    ('delta', 'd-manifest.txt')):
+            if not os.path.isdir(j(home, version, container)):
+                continue
+            manifest_file = j(home, version, manifest)
+            tmp_file = _tmp_name(manifest_file)
+            entries = _sorted_manifest_entries(home, version, manifest)
+            with open(tmp_file, 'w') as f:
+                while True:
+                    batch = [e for _, e in zip(range(workers * 8), entries)]
+                    if not batch:
+                        break
+                    digests = _map(lambda e: _digests(
+                        j(home, version, container, e[0]),
+                        [e[1], algorithm]), batch, workers)
+                    for (filename, old_algorithm, old_digest), (old, new) in \
+                            zip(batch, digests):
+                        if old != old_digest:
+                            path = '%s/%s/%s' % (version, container, filename)
+                            mismatched.append(path)
+                            _print("mismatched: %s" % path)
+                            f.write("%s %s %s\n" % (quote(filename),
+                                                    old_algorithm, old_digest))
+                        else:
+                            f.write("%s %s %s\n" % (quote(filename),
+                                                    algorithm, new))
+                            migrated += 1
+            os.rename(tmp_file, manifest_file)
+    _set_info(home, 'Digest-algorithm', algorithm)
+    if _index_file(home):
+        _build_index(home, _index_file(home)).close()
+    logging.info('migrated %i files to %s, %i mismatched', migrated,
+                 algorithm, len(mismatched))
+    _print("migrated %i files to %s" % (migrated, algorithm))
+    return mismatched
+
+class _LRUCache(object):
+    """
+    A thread-safe cache of what was read from files, kept under a ceiling of
+    estimated bytes by evicting the least recently used entries. Each entry
+    has a stamp, and is only returned while the caller's stamp matches it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp=None):
+        """Return (True, value) for a fresh entry, or (False, None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, stamp, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (stamp, value, size)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
+
+# the cache of parsed manifests, version lists and current versions
+_CACHE = _LRUCache(CACHE_BYTES)
+
+class _Throttle(object):
+    """
+    A thread-safe budget of bytes and reads per second. Calling it with the
+    size of a read sleeps for as long as it takes to stay within budget.
+    """
+
+    def __init__(self, rate=None, iops=None):
+        self.rate = rate * 1e6 if rate else None
+        self.iops = iops
+        self.start = time.time()
+        self.bytes = 0
+        self.ops = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, nbytes, ops=1):
+        if not self.rate and not self.iops:
+            return
+        with self.lock:
+            self.bytes += nbytes
+            self.ops += ops
+            due = self.start
+            if self.rate:
+                due = max(due, self.start + self.bytes / self.rate)
+            if self.iops:
+                due = max(due, self.start + self.ops / float(self.iops))
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+class _Profile(object):
+    """
+    Timers and counters for the phases of a command, which worker threads
+    may add to at the same time.
+    """
+
+    def __init__(self, command, home, listener=None):
+        self.command = command
+        self.home = home
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+        if self.listener:
+            self.listener({'command': self.command, 'phase': phase,
+                           'seconds': seconds})
+
+    def count(self, counter, n=1):
+        with self.lock:
+            value = self.counters[counter] = self.counters.get(counter, 0) + n
+        if self.listener:
+            self.listener({'command': self.command, 'counter': counter,
+                           'value': value})
+
+    def record(self):
+        """Return the profile as a dictionary that can be dumped as JSON."""
+        with self.lock:
+            return {
+                'command': self.command,
+                'home': os.path.abspath(self.home),
+                'seconds': time.time() - self.start,
+                'cpu_seconds': time.process_time() - self.cpu_start,
+                'phases': dict((phase, {'seconds': seconds, 'calls': calls})
+                               for phase, (seconds, calls)
+                               in self.phases.items()),
+                'counters': dict(self.counters),
+            }
+
+@contextlib.contextmanager
+def _phase(name):
+    """Time a phase of the command being profiled in this thread, if any."""
+    profile = getattr(_PROFILING, 'profile', None)
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+def _timed(name, iterator):
+    """
+    Generate the items of an iterator, timing the work of producing them as
+    a phase of the command being profiled in this thread, but not what is
+    done with each of them in between.
+    """
+    profile = getattr(_PROFILING, 'profile', None)
+    if profile is None:
+        for item in iterator:
+            yield item
+        return
+    seconds = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            yield item
+    finally:
+        profile.add(name, seconds)
 
-    changed = False
-    if len(delta['deleted']) > 0:
-        changed = True
-        os.mkdir(j(redd_home, 'add'))
-        for filename in delta['deleted']:
-            os.renames(j(home, current_version, 'full', filename),
-                       j(redd_home, 'add', filename))
-    if len(delta['added']) > 0:
-        changed = True
-        delete = open(j(redd_home, 'delete.txt'), 'w')
-        for filename in delta['added']:
-            delete.write("%s\n" % quote(filename))
-        delete.close()
-
-    if len(delta['modified']) > 0:
-        changed = True
-        if not os.path.isdir(j(redd_home, 'add')):
-            os.mkdir(j(redd_home, 'add'))
-        delete = open(j(redd_home, 'delete.txt'), 'a')
-        for filename in delta['modified']:
-            delete.write("%s\n" % quote(filename))
-            os.renames(j(home, current_version, 'full', filename),
-                       j(redd_home, 'add', filename))
-        delete.close()
-
-    shutil.rmtree(j(home, current_version, 'full'))
-    _set_current(home, modified_version)
+def _count(name, n=1):
+    """Add to a counter of the command being profiled in this thread."""
+    profile = getattr(_PROFILING, 'profile', None)
+    if profile is not None:
+        profile.count(name, n)
 
-    if changed:
-        _update_manifest(j(home, current_version), is_delta=True)
+def _profiled(func):
+    """
+    Wrap a function that will run on a worker thread so that its phases
+    and counters go to the profile of the thread that wrapped it.
+    """
+    profile = getattr(_PROFILING, 'profile', None)
+    if profile is None:
+        return func
 
-    logging.info('committed %s %s', modified_version, delta)
-    _print("committed %s" % modified_version)
+    @wraps(func)
+    def new_f(*args, **kwargs):
+        _PROFILING.profile = profile
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _PROFILING.profile = None
+    return new_f
 
-    return delta
+def _finish_profile(profile):
+    """
+    Log a finished command's profile as JSON, pass it to the profile hooks
+    and print it if --profile was given.
+    """
+    record = profile.record()
+    logging.info('profile %s', json.dumps(record, sort_keys=True))
+    for hook in list(_PROFILE_HOOKS):
+        try:
+            hook(record)
+        except Exception:
+            logging.exception('profile hook %r failed', hook)
+    if getattr(_OUTPUT, 'profile', False):
+        out = _stream('stderr')
+        out.write("%s: %.3fs (%.3fs cpu)\n" % (record['command'],
+                                               record['seconds'],
+                                               record['cpu_seconds']))
+        for phase, totals in sorted(record['phases'].items(),
+                                    key=lambda p: -p[1]['seconds']):
+            out.write("  %-16s %10.3fs %6.1f%% %8i calls\n" %
+                      (phase, totals['seconds'], 100 * totals['seconds'] /
+                       (record['seconds'] or 1), totals['calls']))
+        for counter, value in sorted(record['counters'].items()):
+            out.write("  %-16s %11i\n" % (counter, value))
 
-# TODO: add lock decorator?
-@log
-def export(home, version):
-    """Export the specified version of the Dflat."""
-    # validate specified version
-    versions = _versions(home)
-    if version not in versions:
-        raise Exception("version %s not found in %s" %
-                        (version, ", ".join(versions)))
-    # copy the latest version
-    current_version = _current_version(home)
-    export_version = 'export-%s' % version
-    _copy_tree(j(home, current_version), j(home, export_version))
-    # walk back from latest version-1 to specified version, applying changes
-    delta_versions = _versions(home,
-                               reverse=True,
-                               from_version=current_version,
-                               to_version=version)[1:]
-    # apply adds, deletes, and replaces
-    for delta in delta_versions:
-        # delete deleted files
-        if os.path.isfile(j(home, delta, 'delta', 'delete.txt')):
-            with open(j(home, delta, 'delta', 'delete.txt')) as f:
-                deletes = f.read().split()
-                for delete in deletes:
-                    os.remove(j(home, export_version, 'full',
-                                unquote(delete)))
-
-        # add added files
-        if os.path.isdir(j(home, delta, 'delta', 'add')):
-            for filename in os.listdir(j(home, delta, 'delta', 'add')):
-                _copy_tree(j(home, delta, 'delta', 'add', filename),
-                           j(home, export_version, 'full', filename))
-    logging.info('exported version %s', version)
-
-def status(home):
-    """Print current status of the Dflat."""
-    _print("dflat home: %s" % home)
-    current_version = _current_version(home)
-    _print("current version: %s" % current_version)
-    latest_version = _latest_version(home)
-    _print("working version: %s" % latest_version)
-    if current_version == latest_version:
-        _print("no changes")
-        delta = None
-    else:
-        _update_manifest(j(home, latest_version))
-        delta = _delta(home, current_version, latest_version)
-        _print_delta_files(delta, 'added')
-        _print_delta_files(delta, 'modified')
-        _print_delta_files(delta, 'deleted')
-    return delta
+def _update_manifest(version_dir, is_delta=False, workers=1, processes=False,
+                     paranoid=False, algorithm=None, journal=False):
+    """
+    Update the manifest for a specific version of the Dflat, checksumming
+    files on a pool of worker threads (or processes) when workers > 1. The
+    digest algorithm defaults to the one recorded in dflat-info.txt.
 
-def _update_manifest(version_dir, is_delta=False):
-    """Update the manifest for a specific version of the Dflat."""
+    Digests of full versions are kept in a fixity cache, and files whose
+    size, mtime, inode and ctime are unchanged since they were last
+    checksummed are not read again unless paranoid is set. If journal is
+    set and a watcher is keeping a change journal for the version, only
+    the paths journaled since the manifest was last updated are looked at.
+    """
     if is_delta:
         container_dir = j(version_dir, 'delta')
         manifest_file = j(version_dir, 'd-manifest.txt')
@@ -239,50 +2170,330 @@ def _update_manifest(version_dir, is_delta=False):
         container_dir = j(version_dir, 'full')
         manifest_file = j(version_dir, 'manifest.txt')
 
-    manifest = open(manifest_file, 'w')
+    if algorithm is None:
+        algorithm = _algorithm(os.path.dirname(os.path.abspath(version_dir)))
+    checksum = partial(_digest, algorithm=algorithm)
+    scan_time = time.time_ns()
+    journaled = None
+    if journal and not is_delta and not paranoid:
+        # wait for the watcher, if any, to journal every change made so far
+        journaled = _journal_sync(version_dir)
+    known = {}
+    # manifests are sorted so that deltas can be found by merging them
+    with _phase('manifest.walk'):
+        if journaled and journaled[2] is not None and \
+                os.path.isfile(manifest_file):
+            # files under no journaled path keep their digests
+            known = _journal_unchanged(manifest_file, journaled[2],
+                                       algorithm)
+            filenames = sorted(set(known) | set(
+                _journal_files(container_dir, journaled[2])))
+        else:
+            filenames = sorted(_manifest_files(container_dir))
+    _count('manifest.files', len(filenames))
+    if is_delta:
+        with _phase('manifest.hash'):
+            digests = _map(checksum, [j(container_dir, f) for f in filenames],
+                           workers=workers, processes=processes)
+    else:
+        with _phase('manifest.stat'):
+            cache = {} if paranoid else _read_fixity_cache(version_dir)
+            cached_stats = dict((f, stat) for f, stat, a in cache
+                                if a == algorithm and f in known)
+            stats = [cached_stats.get(f) if f in known else
+                     _fixity_stat(j(container_dir, f)) for f in filenames]
+            digests = [known.get(f) or cache.get((f, s, algorithm))
+                       for f, s in zip(filenames, stats)]
+        stale = [i for i, digest in enumerate(digests) if digest is None]
+        with _phase('manifest.hash'):
+            fresh = _map(checksum,
+                         [j(container_dir, filenames[i]) for i in stale],
+                         workers=workers, processes=processes)
+        for i, digest in zip(stale, fresh):
+            digests[i] = digest
+        # unchanged files that were too new for the cache stay out of it
+        cached = [i for i, stat in enumerate(stats) if stat is not None]
+        _write_fixity_cache(version_dir, [filenames[i] for i in cached],
+                            [stats[i] for i in cached],
+                            [(algorithm, digests[i]) for i in cached],
+                            scan_time)
+
+    # readers holding shared locks may be updating the same manifest
+    tmp_file = _tmp_name(manifest_file)
+    with _phase('manifest.write'):
+        with open(tmp_file, 'w') as manifest:
+            for filename, digest in zip(filenames, digests):
+                manifest.write("%s %s %s\n" % (quote(filename), algorithm,
+                                               digest))
+        os.rename(tmp_file, manifest_file)
+    if journaled:
+        _journal_consumed(version_dir, journaled)
+    return manifest_file
+
+def _fixity_stat(filename):
+    """Return the (size, mtime, inode, ctime) tuple used by the fixity cache."""
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+def _fixity_cache_file(version_dir):
+    """Return the path of the fixity cache for a version of the Dflat."""
+    version_dir = os.path.abspath(version_dir)
+    return j(os.path.dirname(version_dir), 'cache',
+             'fixity-%s.txt' % os.path.basename(version_dir))
+
+def _read_fixity_cache(version_dir):
+    """
+    Read the fixity cache for a version into a dictionary mapping
+    (filename, stat tuple, algorithm) to digest.
+    """
+    cache = {}
+    cache_file = _fixity_cache_file(version_dir)
+    if not os.path.isfile(cache_file):
+        return cache
+    with open(cache_file) as f:
+        for line in f:
+            cols = line.split()
+            if len(cols) != 7:
+                continue
+            stat = tuple(int(col) for col in cols[1:5])
+            cache[(unquote(cols[0]), stat, cols[5])] = cols[6]
+    return cache
+
+def _write_fixity_cache(version_dir, filenames, stats, digests, scan_time):
+    """
+    Atomically replace the fixity cache for a version of the Dflat with
+    the (algorithm, digest) pairs of its files.
+    """
+    cache_file = _fixity_cache_file(version_dir)
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    tmp_file = _tmp_name(cache_file)
+    with open(tmp_file, 'w') as f:
+        for filename, stat, digest in zip(filenames, stats, digests):
+            # the file may still be changing without its mtime moving
+            if stat[1] >= scan_time - RACY_WINDOW:
+                continue
+            f.write("%s %i %i %i %i %s %s\n" %
+                    ((quote(filename),) + stat + digest))
+    os.rename(tmp_file, cache_file)
+
+def _seed_fixity_cache(home, version, new_version):
+    """
+    Populate the fixity cache of a newly checked out version using the
+    digests in the manifest of the version it was cloned from.
+    """
+    scan_time = time.time_ns()
+    manifest = _manifest_dict(home, version)
+    filenames = [f for f in manifest
+                 if os.path.isfile(j(home, new_version, 'full', f))]
+    stats = [_fixity_stat(j(home, new_version, 'full', f)) for f in filenames]
+    digests = [manifest[f] for f in filenames]
+    _write_fixity_cache(j(home, new_version), filenames, stats, digests,
+                        scan_time)
+
+def _tmp_name(filename):
+    """Return a temporary name to write a file under before renaming it."""
+    return '%s.%i-%i.tmp' % (filename, os.getpid(), threading.get_ident())
+
+def _remove_fixity_cache(version_dir):
+    """Remove the fixity cache for a version that is no longer full."""
+    cache_file = _fixity_cache_file(version_dir)
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+
+def _manifest_files(container_dir):
+    """
+    Generate the paths, relative to the container directory, of the files
+    that belong in its manifest.
+    """
     for dirpath, _, filenames in os.walk(container_dir):
+        dirpath = os.path.relpath(dirpath, container_dir)
+        if dirpath == os.curdir:
+            dirpath = ''
         for filename in filenames:
-            if dirpath != 'full' and filename in ('manifest.txt', 'lock.txt'):
+            if filename in ('manifest.txt', 'lock.txt'):
                 continue
-            # make the filename relative to the container directory
-            dirpath = re.sub(r'^%s/?' % container_dir, '', dirpath)
-            md5 = _md5(j(container_dir, dirpath, filename))
-            filename = quote(j(dirpath, filename))
-            manifest.write("%s md5 %s\n" % (filename, md5))
-    manifest.close()
-    return manifest_file
+            yield j(dirpath, filename)
+
+def _map(func, items, workers=1, processes=False):
+    """
+    Return the results of applying func to each item, in order, using a pool
+    of worker threads or processes when more than one worker is requested.
+    A workers value of 0 or None means one worker per CPU.
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, min(64, len(items) // (workers * 4)))
+    else:
+        # hashlib releases the GIL while digesting large buffers
+        executor = ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+        func = _profiled(func)
+    with executor:
+        return list(executor.map(func, items, chunksize=chunksize))
 
 def _current_version(home):
     """Return the current version of the Dflat."""
     current_file = j(home, 'current.txt')
     if os.path.isfile(current_file):
-        with open(current_file, 'r') as f:
-            return f.read()
+        return _cached(current_file, partial(_read_file, current_file))
     return None
 
+def _read_file(filename):
+    """Return the contents of a text file."""
+    with open(filename, 'r') as f:
+        return f.read()
+
 def _anvl(name, value):
     """Encode a name-value pair as an ANVL string."""
     return "%s: %s\n" % (name, value)
 
-def _get_lock(home, caller):
-    """Obtain a LockIt lock."""
+def _info(home):
+    """Parse dflat-info.txt into a list of (name, value) pairs."""
+    info = []
+    with open(j(home, 'dflat-info.txt')) as f:
+        for line in f:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                info.append((name.strip(), value.strip()))
+    return info
+
+def _set_info(home, name, value):
+    """Set, or remove when value is None, a name in dflat-info.txt."""
+    info = [(n, v) for n, v in _info(home) if n != name]
+    if value is not None:
+        info.append((name, value))
+    with open(j(home, 'dflat-info.txt'), 'w') as f:
+        for n, v in info:
+            f.write(_anvl(n, v))
+
+def _get_lock(home, caller, shared=False, wait=0, stale_after=None):
+    """
+    Obtain a LockIt lock, waiting up to wait seconds for it.
+
+    An advisory flock on the Dflat home serializes writers, and lets any
+    number of readers in at once with a shared lock. Writers also create
+    lock.txt for other LockIt aware tools, recording their host and pid in
+    the agent so that a lock.txt left behind by a crashed process can be
+    recognized as stale and removed. A lock.txt without a live holder on
+    this host is also stale once it is older than stale_after seconds.
+    """
     # TODO: log this operation?
     lockfile = j(home, 'lock.txt')
-    if os.path.isfile(lockfile):
-        raise Exception("already locked")
-    timestamp = _rfc3339(datetime.datetime.now())
-    agent = "dflat-%s" % caller.__name__
-    lockfile = open(lockfile, 'w')
-    lockfile.write("Lock: %s %s\n" % (timestamp, agent))
-    lockfile.close()
+    deadline = time.time() + (wait or 0)
+    delay = 0.01
+    while True:
+        fd = os.open(home, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) |
+                        fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        else:
+            # failing to write lock.txt is an error, not contention
+            try:
+                if shared:
+                    if not os.path.isfile(lockfile) or \
+                            _stale_lock(lockfile, stale_after):
+                        break
+                elif _create_lockfile(lockfile, caller):
+                    break
+                elif _stale_lock(lockfile, stale_after):
+                    logging.warning("removing stale lock: %s",
+                                    _read_lockfile(lockfile))
+                    _remove_lockfile(lockfile)
+                    if _create_lockfile(lockfile, caller):
+                        break
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+        now = time.time()
+        if now >= deadline:
+            raise LockedError("already locked")
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, 1.0)
+    _LOCKS.setdefault(_lock_key(home), []).append((fd, not shared))
 
 def _release_lock(home):
     """Release a LockIt lock."""
     # TODO: log this operation?
     lockfile = j(home, 'lock.txt')
-    if not os.path.isfile(lockfile):
-        return
-    os.remove(lockfile)
+    held = _LOCKS.get(_lock_key(home))
+    fd, exclusive = held.pop() if held else (None, True)
+    if not held:
+        _LOCKS.pop(_lock_key(home), None)
+    if exclusive:
+        _remove_lockfile(lockfile)
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def _lock_key(home):
+    """Key a lock held by this process on its Dflat home and thread."""
+    return (os.path.abspath(home), threading.get_ident())
+
+def _create_lockfile(lockfile, caller):
+    """Atomically create lock.txt, returning False if it already exists."""
+    timestamp = _rfc3339(datetime.datetime.now())
+    agent = "dflat-%s@%s:%i" % (caller.__name__, socket.gethostname(),
+                                os.getpid())
+    try:
+        fd = os.open(lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    with os.fdopen(fd, 'w') as f:
+        f.write("Lock: %s %s\n" % (timestamp, agent))
+    return True
+
+def _read_lockfile(lockfile):
+    """Return the contents of lock.txt, or '' if it has gone."""
+    try:
+        with open(lockfile) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+def _remove_lockfile(lockfile):
+    """Remove lock.txt if it exists."""
+    try:
+        os.remove(lockfile)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _stale_lock(lockfile, stale_after=None):
+    """
+    Is lock.txt stale? It is when its holder ran on this host and is no
+    longer alive, or when it is older than stale_after seconds.
+    """
+    match = re.match(r'^Lock: \S+ \S+@(\S+):(\d+)$', _read_lockfile(lockfile))
+    if match and match.group(1) == socket.gethostname() and \
+            not _pid_alive(int(match.group(2))):
+        return True
+    if stale_after is not None:
+        try:
+            return time.time() - os.path.getmtime(lockfile) > stale_after
+        except OSError:
+            return True
+    return False
+
+def _pid_alive(pid):
+    """Is there a process with this pid on this host?"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    return True
 
 def _new_version(home):
     """Create base directories for a new full version of the Dflat."""
@@ -313,7 +2524,9 @@ def _latest_version(home):
 
 def _versions(home, reverse=False, from_version=None, to_version=None):
     """Return an array of all versions in the Dflat."""
-    versions = [x for x in os.listdir(home) if re.match(r'^v\d+$', x)]
+    versions = list(_cached(home, lambda: [x for x in os.listdir(home)
+                                           if re.match(r'^v\d+$', x)],
+                            lambda names: CACHE_ENTRY_BYTES * len(names)))
     if from_version:
         versions = [x for x in versions
                     if _version_number(x) <= _version_number(from_version)]
@@ -331,86 +2544,475 @@ def _version_number(version_dir):
     """Convert a version directory name to an integer."""
     return int(version_dir[1:])
 
-def _md5(filename):
+def _md5(filename, throttle=None):
     """Helper method to checksum files for a Dflat manifest."""
-    with open(filename, 'rb') as f:
-        md5 = hashlib.md5()
-        while True:
-            byte_string = f.read(0x1000)
-            if not byte_string:
-                break
-            md5.update(byte_string)
-        f.close()
-        return md5.hexdigest()
+    return _digest(filename, 'md5', throttle)
+
+def _digest(filename, algorithm='md5', throttle=None):
+    """
+    Checksum a file with the given algorithm, calling throttle with the
+    size of each read if given.
+    """
+    return _digests(filename, [algorithm], throttle)[0]
+
+def _digests(filename, algorithms, throttle=None):
+    """
+    Checksum a file with several algorithms in a single pass over its
+    contents, returning a list of hex digests.
+    """
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    size = 0
+    with _phase('digest'):
+        with open(filename, 'rb') as f:
+            while True:
+                byte_string = f.read(BUFFER_SIZE)
+                if throttle:
+                    throttle(len(byte_string))
+                if not byte_string:
+                    break
+                size += len(byte_string)
+                for h in hashes:
+                    h.update(byte_string)
+    _count('digest.files')
+    _count('digest.bytes', size)
+    return [h.hexdigest() for h in hashes]
+
+def _algorithm(home):
+    """Return the digest algorithm new manifests in the Dflat use."""
+    if not os.path.isfile(j(home, 'dflat-info.txt')):
+        return 'md5'
+    return dict(_info(home)).get('Digest-algorithm', 'md5')
 
 def _delta(home, old_version, new_version):
     """
     Determine which files must be added to or removed from an old version to
     obtain a new version.
     """
-    delta = {'modified': [], 'deleted': [], 'added': []}
-    manifest_old_version = _manifest_dict(home, old_version)
-    manifest_new_version = _manifest_dict(home, new_version)
-    for filename in list(manifest_new_version.keys()):
-        if filename in manifest_old_version:
-            if manifest_new_version[filename] != manifest_old_version[filename]:
-                delta['modified'].append(filename)
+    return Delta(home, old_version, new_version)
+
+class Delta(object):
+    """
+    The files added, modified, deleted and renamed between two versions of
+    the Dflat. Iterating over a Delta yields (kind, filename) pairs in
+    filename order by merging the two manifests line by line, so even very
+    large deltas are never held in memory. Renamed files are given by their
+    new names. Indexing it by kind returns a list, as the dictionary that
+    used to represent deltas did.
+    """
+    kinds = ('modified', 'deleted', 'added', 'renamed')
+
+    def __init__(self, home, old_version, new_version):
+        self.home = home
+        self.old_version = old_version
+        self.new_version = new_version
+        self._counts = None
+
+    def __iter__(self):
+        for kind, old_entry, new_entry in self.entries():
+            yield kind, (new_entry or old_entry)[0]
+
+    def __getitem__(self, kind):
+        if kind not in self.kinds:
+            raise KeyError(kind)
+        return list(self.files(kind))
+
+    def entries(self):
+        """
+        Generate (kind, old entry, new entry) tuples, giving the manifest
+        entries of each changed file in the old and new versions. The
+        counts of a complete pass are kept, so that counts doesn't have to
+        merge the manifests again.
+        """
+        counts = dict((kind, 0) for kind in self.kinds)
+        for kind, old_entry, new_entry in _delta_entries(
+                self.home, self.old_version, self.new_version):
+            counts[kind] += 1
+            yield kind, old_entry, new_entry
+        self._counts = counts
+
+    def files(self, kind):
+        """Generate the filenames with the given kind of change."""
+        for k, filename in self:
+            if k == kind:
+                yield filename
+
+    def renames(self):
+        """Generate (old filename, new filename) pairs for renamed files."""
+        for kind, old_entry, new_entry in self.entries():
+            if kind == 'renamed':
+                yield old_entry[0], new_entry[0]
+
+    def counts(self):
+        """Return the number of files with each kind of change."""
+        if self._counts is None:
+            for _ in self.entries():
+                pass
+        return dict(self._counts)
+
+    def keys(self):
+        return list(self.kinds)
+
+    def values(self):
+        return [self[kind] for kind in self.kinds]
+
+    def items(self):
+        return [(kind, self[kind]) for kind in self.kinds]
+
+def _delta_entries(home, old_version, new_version):
+    """
+    Generate (kind, old entry, new entry) tuples for the files added,
+    modified, deleted or renamed between two versions, where the entries
+    are the (filename, algorithm, digest) tuples from each manifest, or
+    None.
+
+    When the Dflat detects renames, a deleted file and an added file with
+    the same digest and size are a rename. Finding them takes a first pass
+    over the delta that holds the deleted and added files that haven't been
+    paired up yet.
+    """
+    merge = _timed('delta', _delta_merge(home, old_version, new_version))
+    if not _detect_renames(home):
+        for entry in merge:
+            yield entry
+        return
+    renamed = _delta_renamed(home, old_version, new_version)
+    paired = set(renamed.values())
+    for kind, old_entry, new_entry in merge:
+        if kind == 'deleted' and old_entry in paired:
+            continue
+        if kind == 'added' and new_entry in renamed:
+            yield 'renamed', renamed[new_entry], new_entry
         else:
-            delta['added'].append(filename)
-    for filename in list(manifest_old_version.keys()):
-        if filename not in manifest_new_version:
-            delta['deleted'].append(filename)
-    return delta
+            yield kind, old_entry, new_entry
 
-def _print_delta_files(delta, dtype):
-    """Print the files which appear in a delta between Dflat versions."""
-    files = delta[dtype]
-    files.sort()
-    if len(files) > 0:
-        _print("%s:" % dtype)
-        for filename in files:
-            _print("  %s" % unquote(filename))
+def _delta_renamed(home, old_version, new_version):
+    """
+    Return a dictionary mapping the manifest entries of files added in the
+    new version to the entries of deleted files they are renames of.
+    """
+    renamed = {}
+    deleted = {}
+    added = {}
+    with _phase('delta'):
+        for kind, old_entry, new_entry in _delta_merge(home, old_version,
+                                                       new_version):
+            if kind == 'deleted':
+                candidates = added.get(old_entry[1:], [])
+                for i, candidate in enumerate(candidates):
+                    if _same_size(home, old_version, new_version, old_entry,
+                                  candidate):
+                        renamed[candidates.pop(i)] = old_entry
+                        break
+                else:
+                    deleted.setdefault(old_entry[1:], []).append(old_entry)
+            elif kind == 'added':
+                candidates = deleted.get(new_entry[1:], [])
+                for i, candidate in enumerate(candidates):
+                    if _same_size(home, old_version, new_version, candidate,
+                                  new_entry):
+                        renamed[new_entry] = candidates.pop(i)
+                        break
+                else:
+                    added.setdefault(new_entry[1:], []).append(new_entry)
+    return renamed
+
+def _same_size(home, old_version, new_version, old_entry, new_entry):
+    """
+    Are the files for two manifest entries the same size? Manifests don't
+    record sizes, so this is only checked where both files are on disk.
+    """
+    old_file = j(home, old_version, 'full', old_entry[0])
+    new_file = j(home, new_version, 'full', new_entry[0])
+    if not (os.path.isfile(old_file) and os.path.isfile(new_file)):
+        return True
+    return os.path.getsize(old_file) == os.path.getsize(new_file)
+
+def _delta_merge(home, old_version, new_version):
+    """
+    Generate (kind, old entry, new entry) tuples for the files added,
+    modified or deleted between two versions, matching files by name alone.
+    """
+    old = _sorted_manifest_entries(home, old_version, indexed=True)
+    new = _sorted_manifest_entries(home, new_version, indexed=True)
+    old_entry = next(old, None)
+    new_entry = next(new, None)
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or \
+                (old_entry is not None and old_entry[0] < new_entry[0]):
+            yield 'deleted', old_entry, None
+            old_entry = next(old, None)
+        elif old_entry is None or new_entry[0] < old_entry[0]:
+            yield 'added', None, new_entry
+            new_entry = next(new, None)
+        else:
+            if not _same_digest(home, new_version, old_entry, new_entry):
+                yield 'modified', old_entry, new_entry
+            old_entry = next(old, None)
+            new_entry = next(new, None)
+
+def _same_digest(home, new_version, old_entry, new_entry):
+    """
+    Do two manifest entries for a file have the same contents? When they
+    were made with different algorithms the file in the new version is
+    checksummed again with the old algorithm.
+    """
+    if old_entry[1] == new_entry[1]:
+        return old_entry[2] == new_entry[2]
+    filename = j(home, new_version, 'full', new_entry[0])
+    return _digest(filename, old_entry[1]) == old_entry[2]
+
+def _sorted_manifest_entries(home, version, manifest='manifest.txt',
+                             indexed=False):
+    """
+    Generate (filename, algorithm, digest) tuples from a manifest in
+    filename order.
+    Manifests written by older versions of dflat may not be sorted, and
+    are sorted in memory. If indexed is set, manifests of committed
+    versions are read from the index when there is one; fixity checks
+    leave it unset so that they check the Checkm files themselves.
+    """
+    if indexed and manifest == 'manifest.txt' and \
+            _version_number(version) <= \
+            _version_number(_current_version(home)):
+        db = _index(home)
+        if db is not None:
+            return _index_entries(db, version)
+    manifest_file = j(home, version, manifest)
+    if not _cached(manifest_file, partial(_manifest_sorted, manifest_file),
+                   lambda is_sorted: CACHE_ENTRY_BYTES,
+                   key=('sorted', manifest_file)):
+        return iter(sorted(_manifest_entries(home, version, manifest)))
+    return _manifest_entries(home, version, manifest)
+
+def _manifest_sorted(manifest_file):
+    """
+    Is a manifest in filename order? Only its filenames are looked at, so
+    this is cheaper than parsing it.
+    """
+    previous = None
+    with open(manifest_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            filename = line.split(' ', 1)[0]
+            if '%' in filename:
+                filename = unquote(filename)
+            if previous is not None and filename < previous:
+                return False
+            previous = filename
+    return True
 
 def _has_changes(delta):
     """Does the delta contain any changes?"""
-    for value in list(delta.values()):
-        if len(value) > 0:
-            return True
-    return False
+    return any(delta.counts().values())
+
+def _print_delta_files(dtype, filenames):
+    """Print the files with one kind of change in a delta."""
+    if filenames:
+        _print("%s:" % dtype)
+    for filename in filenames:
+        _print("  %s" % filename)
 
 def _manifest_dict(home, version):
-    """Parse a Checkm manifest into a dictionary."""
-    manifest_dict = {}
-    with open(j(home, version, 'manifest.txt')) as f:
+    """
+    Parse a Checkm manifest into a dictionary mapping filenames to
+    (algorithm, digest) pairs.
+    """
+    return dict((filename, (algorithm, digest)) for filename, algorithm, digest
+                in _manifest_entries(home, version))
+
+def _manifest_entries(home, version, manifest='manifest.txt'):
+    """
+    Return an iterator of (filename, algorithm, digest) tuples from a Checkm
+    manifest, which is parsed again only when it changes.
+    """
+    manifest_file = j(home, version, manifest)
+    if not _CACHE.max_bytes:
+        return _read_manifest(manifest_file)
+    stat = _fixity_stat(manifest_file)
+    found, entries = _CACHE.get(manifest_file, stat)
+    if found:
+        return iter(entries)
+    if stat[1] >= time.time_ns() - RACY_WINDOW or \
+            _manifest_bytes(manifest_file, stat[0]) > _CACHE.max_bytes:
+        # may still be changing, or too big to cache
+        return _read_manifest(manifest_file)
+    return _read_manifest_caching(manifest_file, stat)
+
+def _manifest_bytes(manifest_file, size):
+    """
+    Estimate the bytes of memory the parsed entries of a manifest take up,
+    from the number of lines in its first block.
+    """
+    with open(manifest_file, 'rb') as f:
+        block = f.read(BUFFER_SIZE)
+    lines = block.count(b'\n') * size // (len(block) or 1)
+    return size + CACHE_ENTRY_BYTES * lines
+
+def _read_manifest_caching(manifest_file, stat):
+    """
+    Generate the entries of a manifest like _read_manifest, caching them
+    once they have all been read if they fit under the cache's ceiling.
+    Entries stop being kept as soon as they don't, in case the estimate
+    that they would was wrong.
+    """
+    entries = []
+    size = 0
+    for entry in _read_manifest(manifest_file):
+        if entries is not None:
+            size += CACHE_ENTRY_BYTES + len(entry[0]) + len(entry[1]) + \
+                len(entry[2])
+            if size > _CACHE.max_bytes:
+                entries = None
+            else:
+                entries.append(entry)
+        yield entry
+    if entries is not None:
+        _CACHE.put(manifest_file, stat, entries, size)
+
+def _read_manifest(manifest_file):
+    """Generate (filename, algorithm, digest) tuples from a Checkm manifest."""
+    with open(manifest_file) as f:
         for line in f:
             if line.startswith('#'):
                 continue
             cols = line.split()
-            manifest_dict[unquote(cols[0])] = cols[2]
-        return manifest_dict
+            yield unquote(cols[0]), cols[1], cols[2]
+
+def _cached(filename, load, size=len, key=None):
+    """
+    Return what load reads from a file or directory, or what it read before
+    if the fixity stat of the file is unchanged since. size estimates the
+    bytes of memory what was read takes up. The cache is keyed by the
+    filename unless another key is given. Like the fixity cache, files
+    modified within the racy window are read every time.
+    """
+    if not _CACHE.max_bytes:
+        return load()
+    key = key or filename
+    stat = _fixity_stat(filename)
+    found, value = _CACHE.get(key, stat)
+    if found:
+        return value
+    value = load()
+    if stat[1] < time.time_ns() - RACY_WINDOW:
+        _CACHE.put(key, stat, value, size(value))
+    return value
+
+def set_cache_size(max_bytes):
+    """
+    Set how many bytes of memory the cache of parsed manifests, version
+    lists and current versions may take up, evicting the least recently
+    used entries to fit. 0 turns the cache off.
+    """
+    _CACHE.resize(max_bytes)
+
+def cache_stats():
+    """
+    Return a dictionary with the hits, misses and evictions of the cache
+    of parsed manifests, version lists and current versions, how many
+    entries and estimated bytes it holds, and its max_bytes.
+    """
+    return _CACHE.stats()
 
 def _dflat_home(directory):
     """
     Return the absolute path of the Dflat containing the given directory,
     if any.
     """
+    found, home = _CACHE.get(('home', directory))
+    if found and os.path.isfile(j(home, 'dflat-info.txt')):
+        return home
     if 'dflat-info.txt' in os.listdir(directory):
-        return os.path.abspath(directory)
+        home = os.path.abspath(directory)
     elif directory == '/':
         return None
     else:
-        return _dflat_home(os.path.abspath(os.path.dirname(directory)))
+        home = _dflat_home(os.path.abspath(os.path.dirname(directory)))
+    if home:
+        _CACHE.put(('home', directory), None, home, len(home))
+    return home
 
 def _option_parser():
     """Construct the option parser."""
-    parser = optparse.OptionParser(usage='''usage: %prog <command> [args]
+    parser = _OptionParser(prog='dflat',
+                           usage='''usage: %prog <command> [args]
     
 commands:
     init      initialize current working directory as a dflat
     checkout  check out a new version of the dflat for modification
     commit    commit new version as the current version of the object
     status    report uncommitted changes to the dflat in the current directory
-    export    export the current version of the dflat into a new directory''')
+    export    export the current version of the dflat into a new directory
+    cat       write a file as it was in a version to standard output
+    get       copy files matching a glob as they were in a version
+    compact   add or remove keyframes to match the keyframe policy
+    verify    check every version and delta against its manifest
+    migrate   rewrite manifests to use the digest algorithm in --algorithm
+    recover   finish or undo a commit that was interrupted
+    reap      delete what commit and compact moved into the trash
+    gc        remove blobs no delta refers to from the content store
+    watch     journal changes to the working version for status and commit
+    index     build the index of versions, files and digests
+    log       list the versions that contain a path
+    find      list the files with the digest in --digest
+    batch     run status, commit, checkout, export or verify on each dflat
+              listed in --from-list, printing results as JSON lines''')
+    parser.add_option('-w', '--workers', type='int', default=1,
+                      help='number of workers used to checksum files '
+                           '(0 for one per CPU)')
+    parser.add_option('--processes', action='store_true', default=False,
+                      help='checksum files in worker processes rather '
+                           'than threads')
+    parser.add_option('--clone', default='copy',
+                      choices=['copy', 'reflink'],
+                      help='how checkout duplicates files: copy or '
+                           'reflink')
+    parser.add_option('-o', '--output',
+                      help='where get writes its files, or where export '
+                           'writes its archive (- for standard output)')
+    parser.add_option('--format', choices=['tar', 'zip'],
+                      help='stream export as a tar or zip archive')
+    parser.add_option('--keyframe-interval', type='int',
+                      help='keep every Nth version full (0 to stop)')
+    parser.add_option('--keyframe-bytes', type='int',
+                      help='keep a version full once this many bytes of '
+                           'deltas have accumulated (0 to stop)')
+    parser.add_option('--from-list',
+                      help='file listing the dflats for batch, one per line')
+    parser.add_option('--per-device', type='int', default=1,
+                      help='dflats on the same device that batch works on '
+                           'at once')
+    parser.add_option('--algorithm', choices=list(DIGEST_ALGORITHMS),
+                      help='digest algorithm for init or migrate')
+    parser.add_option('--dedupe', action='store_true', default=False,
+                      help='deduplicate deltas with a content store')
+    parser.add_option('--index', action='store_true', default=False,
+                      help='keep an index of versions, files and digests')
+    parser.add_option('--digest', help='digest for find to look for')
+    parser.add_option('--patch-threshold', type='int',
+                      help='store modified files of at least this many '
+                           'bytes as binary patches')
+    parser.add_option('--detect-renames', action='store_true', default=False,
+                      help='record renamed files in deltas rather than '
+                           'storing them again')
+    parser.add_option('--rate', type='float',
+                      help='megabytes per second that verify may read')
+    parser.add_option('--iops', type='float',
+                      help='reads per second that verify may make, or '
+                           'deletions per second that reap may make '
+                           '(%i by default, 0 for no limit)' % REAP_IOPS)
+    parser.add_option('--restart', action='store_true', default=False,
+                      help='start verify over rather than resuming it')
+    parser.add_option('--wait', type='float', default=0,
+                      help='seconds to wait for a locked dflat')
+    parser.add_option('--stale-after', type='float',
+                      help='age in seconds at which an unheld lock.txt '
+                           'is removed, even one from another host')
+    parser.add_option('--profile', action='store_true', default=False,
+                      help='print how long each phase of a command took')
+    parser.add_option('--paranoid', action='store_true', default=False,
+                      help='checksum every file, ignoring the fixity cache')
 
     return parser
 
@@ -421,10 +3023,11 @@ def _set_current(home, version):
 
 def _configure_logger(filename):
     """Configure the logger."""
+    _OUTPUT.log_file = filename
     timezone = _timezone()
     logging.basicConfig(filename=filename,
                         level=logging.INFO,
-                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        format=LOG_FORMAT,
                         datefmt='%Y-%m-%dT%H:%M:%S'+timezone)
 
 def _timezone():
@@ -441,27 +3044,654 @@ def _rfc3339(dt):
     """Convert a datetime into an RFC 3339-formatted timestamp."""
     return dt.strftime('%Y-%m-%dT%H:%M:%S') + _timezone()
 
+def _stdout():
+    """Return a binary stream for standard output."""
+    out = _stream('stdout')
+    return getattr(out, 'buffer', out)
+
+def _stream(name):
+    """
+    Return standard output or error, or the stream that dflatd sends them
+    to when it is serving the command line running in this thread.
+    """
+    return getattr(_OUTPUT, name, None) or getattr(sys, name)
+
 def _print(msg):
     """Print messages when in verbose mode."""
     if not _QUIET:
-        print(msg)
+        print(msg, file=_stream('stdout'))
 
-def _copy_tree(src_dir, dest_dir):
+def _copy_tree(src_dir, dest_dir, clone='copy', workers=1):
     """
     Replacement for shutil.copytree that will copy directories that already
-    exist.
+    exist. The tree is walked iteratively with os.scandir and files are
+    copied on a bounded pool of worker threads. Returns a dictionary with
+    the number of files and bytes copied and the seconds it took.
     """
     # shutil.copytree doesn't like copying directories that already exist
     # so here's a new one
+    if os.path.isfile(src_dir):
+        return _copy_files([(src_dir, dest_dir)], clone=clone)
     if not os.path.exists(dest_dir):
         os.mkdir(dest_dir)
-    for filename in os.listdir(src_dir):
-        src = j(src_dir, filename)
-        dest = j(dest_dir, filename)
-        if os.path.isdir(src):
-            if not os.path.exists(dest):
-                os.mkdir(dest)
-                shutil.copystat(src, dest) # preserve permissions manually
-            _copy_tree(src, dest)
+    created = []
+
+    def walk():
+        stack = [(src_dir, dest_dir)]
+        while stack:
+            src, dest = stack.pop()
+            with os.scandir(src) as entries:
+                for entry in entries:
+                    target = j(dest, entry.name)
+                    if entry.is_dir():
+                        if not os.path.exists(target):
+                            os.mkdir(target)
+                            created.append((entry.path, target))
+                        stack.append((entry.path, target))
+                    else:
+                        yield entry.path, target
+
+    copied = _copy_files(walk(), clone=clone, workers=workers)
+    # copying files into directories touches their mtime, so preserve
+    # permissions and timestamps manually once they are full
+    for src, dest in reversed(created):
+        shutil.copystat(src, dest)
+    return copied
+
+def _copy_files(pairs, clone='copy', workers=1, make_dirs=False):
+    """
+    Copy (source, destination) pairs of files on a bounded pool of worker
+    threads, creating missing destination directories if make_dirs is set.
+    Returns a dictionary with the number of files and bytes copied and the
+    seconds it took.
+    """
+    start = time.time()
+    copied = {'files': 0, 'bytes': 0}
+    if not workers:
+        workers = os.cpu_count() or 1
+    dirs = set()
+
+    def tally(futures):
+        for future in futures:
+            copied['files'] += 1
+            copied['bytes'] += future.result()
+
+    pending = set()
+    copy_source = _profiled(_copy_source)
+    with _phase('copy'), ThreadPoolExecutor(max_workers=workers) as executor:
+        for src, dest in pairs:
+            if make_dirs:
+                dest_dir = os.path.dirname(dest)
+                if dest_dir not in dirs:
+                    if not os.path.isdir(dest_dir):
+                        os.makedirs(dest_dir)
+                    dirs.add(dest_dir)
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                tally(done)
+            pending.add(executor.submit(copy_source, src, dest, clone))
+        tally(pending)
+    copied['seconds'] = time.time() - start
+    _count('copy.files', copied['files'])
+    _count('copy.bytes', copied['bytes'])
+    return copied
+
+def _link_file(src, dest):
+    """Hardlink a file that won't change again, copying it if that fails."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        _copy_file(src, dest)
+
+def _copy_rate(copied):
+    """Describe the throughput of a _copy_tree call."""
+    seconds = max(copied['seconds'], 1e-6)
+    return "copied %i files (%i bytes) in %.2fs, %.1f files/s, %.1f MB/s" % (
+        copied['files'], copied['bytes'], copied['seconds'],
+        copied['files'] / seconds, copied['bytes'] / seconds / 1e6)
+
+def _copy_source(src, dest, clone='copy'):
+    """
+    Copy a source from an export plan to dest, writing out patched files in
+    full. Returns the size of the file.
+    """
+    if not isinstance(src, tuple):
+        return _clone_file(src, dest, clone)
+    with _open_source(src) as s:
+        with open(dest, 'wb') as d:
+            shutil.copyfileobj(s, d, BUFFER_SIZE)
+            return d.tell()
+
+def _clone_file(src, dest, clone='copy'):
+    """
+    Duplicate a file by reflink when asked to, falling back to copying its
+    contents when the filesystem can't share them. Returns the size of the
+    file.
+    """
+    if clone == 'reflink':
+        try:
+            with open(src, 'rb') as s:
+                with open(dest, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                    size = os.fstat(s.fileno()).st_size
+            shutil.copystat(src, dest)
+            return size
+        except OSError:
+            if os.path.exists(dest):
+                os.remove(dest)
+    return _copy_file(src, dest)
+
+def _copy_file(src, dest):
+    """
+    Copy a file and its permissions and timestamps, letting the kernel move
+    the bytes with copy_file_range or sendfile where it can. Returns the
+    size of the file.
+    """
+    with open(src, 'rb') as s:
+        with open(dest, 'wb') as d:
+            size = os.fstat(s.fileno()).st_size
+            copied = 0
+            for kernel_copy in (getattr(os, 'copy_file_range', None),
+                                getattr(os, 'sendfile', None)):
+                if kernel_copy is None:
+                    continue
+                try:
+                    while copied < size:
+                        if kernel_copy is os.sendfile:
+                            sent = os.sendfile(d.fileno(), s.fileno(), copied,
+                                               size - copied)
+                        else:
+                            sent = os.copy_file_range(s.fileno(), d.fileno(),
+                                                      size - copied, copied,
+                                                      copied)
+                        if sent == 0:
+                            break
+                        copied += sent
+                    break
+                except OSError:
+                    if copied:
+                        raise
+            if copied < size:
+                s.seek(copied)
+                d.seek(copied)
+                shutil.copyfileobj(s, d, BUFFER_SIZE)
+    shutil.copystat(src, dest) # preserve permissions and timestamps
+    return size
+
+def _make_patch(target, base, patch_file):
+    """
+    Write a binary patch that rebuilds the target file from the base file,
+    rsync style: the base is cut into blocks, and the target is scanned
+    with a rolling Adler-32 checksum for windows that match one of them.
+    Matches become copies from the base and everything else is stored as
+    literal data. Returns False, leaving no patch behind, when the patch
+    wouldn't be worth storing.
+    """
+    target_size = os.path.getsize(target)
+    base_size = os.path.getsize(base)
+    block = max(0x1000, min(0x100000, int(target_size ** 0.5) & ~0xfff))
+    if target_size < block or base_size < block:
+        return False
+    with open(base, 'rb') as b:
+        with open(target, 'rb') as t:
+            base_map = mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ)
+            target_map = mmap.mmap(t.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ops = _patch_ops(target_map, base_map, block,
+                                 int(target_size * PATCH_RATIO))
+                if ops is None:
+                    return False
+                patch_dir = os.path.dirname(patch_file)
+                if patch_dir and not os.path.isdir(patch_dir):
+                    os.makedirs(patch_dir)
+                with open(patch_file, 'wb') as p:
+                    p.write(PATCH_MAGIC)
+                    for op, start, length in ops:
+                        if op == b'C':
+                            p.write(b'C' + struct.pack('>QQ', start, length))
+                        else:
+                            p.write(b'D' + struct.pack('>Q', length))
+                            p.write(target_map[start:start + length])
+            finally:
+                base_map.close()
+                target_map.close()
+    shutil.copystat(target, patch_file)
+    return True
+
+def _patch_ops(target, base, block, max_literal):
+    """
+    Return a list of (op, start, length) tuples that rebuild target from
+    base, where op is b'C' to copy from base at start and b'D' to take
+    literal data from target at start. Returns None if more than
+    max_literal bytes would be literal.
+
+    Windows of the target are checksummed with zlib at block boundaries
+    while they keep matching, and rolled a byte at a time in Python after a
+    mismatch. A long stretch without matches falls back to checking one
+    window per block, so that patching very different files stays cheap.
+    """
+    weak = {}
+    for offset in range(0, len(base) - block + 1, block):
+        weak.setdefault(zlib.adler32(base[offset:offset + block]),
+                        []).append(offset)
+    strong = {}
+
+    def match(position, checksum):
+        """Return the base offset matching the window at position."""
+        offsets = weak.get(checksum)
+        if not offsets:
+            return None
+        digest = hashlib.md5(target[position:position + block]).digest()
+        for offset in offsets:
+            if offset not in strong:
+                strong[offset] = hashlib.md5(
+                    base[offset:offset + block]).digest()
+            if strong[offset] == digest:
+                return offset
+        return None
+
+    ops = []
+    literal = 0
+    literal_start = 0
+    position = 0
+    size = len(target)
+    # bytes that may be rolled through before only checking block boundaries
+    roll_budget = 8 * block
+    rolling = False
+    # the two halves of the adler32 checksum while rolling
+    a = b = 0
+    while position + block <= size:
+        if rolling:
+            out_byte = target[position - 1]
+            in_byte = target[position + block - 1]
+            a = (a - out_byte + in_byte) % 65521
+            b = (b - block * out_byte + a - 1) % 65521
+            checksum = (b << 16) | a
         else:
-            shutil.copy2(src, dest) # copy2 preserves permissions
+            checksum = zlib.adler32(target[position:position + block])
+        offset = match(position, checksum)
+        if offset is not None:
+            if literal_start < position:
+                ops.append((b'D', literal_start, position - literal_start))
+                literal += position - literal_start
+                if literal > max_literal:
+                    return None
+            if ops and ops[-1][0] == b'C' and \
+                    ops[-1][1] + ops[-1][2] == offset:
+                ops[-1] = (b'C', ops[-1][1], ops[-1][2] + block)
+            else:
+                ops.append((b'C', offset, block))
+            position += block
+            literal_start = position
+            rolling = False
+            roll_budget = 8 * block
+        elif roll_budget > 0:
+            if not rolling:
+                a = checksum & 0xffff
+                b = checksum >> 16
+                rolling = True
+            position += 1
+            roll_budget -= 1
+        else:
+            position += block
+            rolling = False
+        if position - literal_start > max_literal:
+            return None
+    if literal_start < size:
+        ops.append((b'D', literal_start, size - literal_start))
+        literal += size - literal_start
+    if literal > max_literal:
+        return None
+    return ops
+
+class _PatchReader(io.RawIOBase):
+    """
+    A seekable, read-only file object for the target of a binary patch,
+    which reads copied ranges from a (seekable) base file object and
+    literal data from the patch itself.
+    """
+
+    def __init__(self, patch_file, base):
+        self.patch = open(patch_file, 'rb')
+        self.base = base
+        if self.patch.read(len(PATCH_MAGIC)) != PATCH_MAGIC:
+            raise Exception("%s is not a dflat patch" % patch_file)
+        # (start in target, length, file object, start in file object)
+        self.ops = []
+        self.starts = []
+        self.size = 0
+        while True:
+            op = self.patch.read(1)
+            if not op:
+                break
+            if op == b'C':
+                offset, length = struct.unpack('>QQ', self.patch.read(16))
+                self.ops.append((self.size, length, self.base, offset))
+            elif op == b'D':
+                length, = struct.unpack('>Q', self.patch.read(8))
+                self.ops.append((self.size, length, self.patch,
+                                 self.patch.tell()))
+                self.patch.seek(length, io.SEEK_CUR)
+            else:
+                raise Exception("corrupt patch %s" % patch_file)
+            self.starts.append(self.size)
+            self.size += length
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buf):
+        if self.position >= self.size:
+            return 0
+        i = bisect.bisect_right(self.starts, self.position) - 1
+        start, length, f, offset = self.ops[i]
+        within = self.position - start
+        f.seek(offset + within)
+        data = f.read(min(len(buf), length - within))
+        buf[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.patch.close()
+            self.base.close()
+        super(_PatchReader, self).close()
+
+class _Watcher(object):
+    """
+    Journals the paths that change in the working version of a Dflat, using
+    inotify through ctypes. Directories are watched one by one, as inotify
+    requires, and the files in directories that appear later are journaled
+    by journaling the directory.
+    """
+
+    def __init__(self, home):
+        self.home = os.path.abspath(home)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise Exception("watch needs inotify")
+        if not os.path.isdir(j(self.home, 'cache')):
+            os.makedirs(j(self.home, 'cache'))
+        self.watch_file = j(self.home, 'cache', 'watch.txt')
+        try:
+            with open(self.watch_file) as f:
+                host, pid = f.read().split()
+            if host == socket.gethostname() and _pid_alive(int(pid)):
+                raise Exception("already watched by %s" % pid)
+        except (IOError, OSError, ValueError):
+            pass
+        with open(self.watch_file, 'w') as f:
+            f.write("%s %i\n" % (socket.gethostname(), os.getpid()))
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.home_wd = self.add(self.home, IN_CLOSE_WRITE | IN_MOVED_TO |
+                                IN_CREATE)
+        self.cache_wd = self.add(j(self.home, 'cache'), IN_CLOSE_WRITE)
+        self.version = None
+        self.journal = None
+        self.dirs = {}
+        self.rearm()
+
+    def add(self, path, mask):
+        """Watch a directory, returning its watch descriptor or None."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return wd
+
+    def add_tree(self, path):
+        """Watch a directory in the working version and those inside it."""
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            directory = j(self.home, self.version, 'full', path)
+            wd = self.add(directory, IN_CHANGES)
+            if wd is None:
+                continue
+            # a directory moved within the version keeps its descriptor
+            self.dirs[wd] = path
+            try:
+                with os.scandir(directory) as entries:
+                    stack.extend(j(path, entry.name) for entry in entries
+                                 if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def rearm(self):
+        """Start journaling the working version, if it has changed."""
+        version = _latest_version(self.home)
+        if version == _current_version(self.home):
+            version = None
+        if version == self.version:
+            return
+        self.stop()
+        self.version = version
+        if version is None:
+            return
+        # wait for checkout to finish copying the version before watching
+        _get_lock(self.home, watch, shared=True, wait=60)
+        try:
+            journal_file = _journal_file(j(self.home, version))
+            self.journal = open(journal_file, 'wb')
+            self.journal.write(("# dflat-watch %s %i %i\n" % (
+                socket.gethostname(), os.getpid(), time.time_ns()))
+                .encode('utf-8'))
+            self.add_tree('')
+            self.journal.flush()
+        finally:
+            _release_lock(self.home)
+        logging.info('watching %s', version)
+
+    def read(self):
+        """Journal the events inotify has waiting."""
+        try:
+            data = os.read(self.fd, 0x10000)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        rearm = False
+        lines = []
+        i = 0
+        while i < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, i)
+            name = os.fsdecode(data[i + 16:i + 16 + length].rstrip(b'\0'))
+            i += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                lines.append('# overflow')
+            elif wd == self.home_wd:
+                if name == 'current.txt' or re.match(r'^v\d+$', name):
+                    rearm = True
+            elif wd == self.cache_wd:
+                prefix = 'journal-%s.sync-' % self.version
+                if self.version and name.startswith(prefix):
+                    lines.append('# sync %s' % name[len(prefix):])
+                    try:
+                        os.remove(j(self.home, 'cache', name))
+                    except OSError:
+                        pass
+            elif wd in self.dirs:
+                path = self.dirs[wd]
+                if mask & IN_IGNORED:
+                    del self.dirs[wd]
+                elif mask & IN_DELETE_SELF or not name:
+                    lines.append(quote(path) if path else '# overflow')
+                else:
+                    child = j(path, name)
+                    lines.append(quote(child))
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(child)
+        if lines and self.journal is not None:
+            self.journal.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            self.journal.flush()
+        if rearm:
+            self.rearm()
+
+    def stop(self):
+        """Stop journaling the working version and remove its journal."""
+        for wd in list(self.dirs):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.dirs = {}
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            for suffix in ('txt', 'pos'):
+                journal_file = _journal_file(j(self.home, self.version),
+                                             suffix)
+                if os.path.isfile(journal_file):
+                    os.remove(journal_file)
+
+    def close(self):
+        self.stop()
+        os.close(self.fd)
+        os.remove(self.watch_file)
+
+class _OptionParser(optparse.OptionParser):
+    """
+    An OptionParser that writes help and errors to the output of the
+    command line, which dflatd sends back to bin/dflat.
+    """
+
+    def print_help(self, file=None):
+        optparse.OptionParser.print_help(self, file or _stream('stdout'))
+
+    def error(self, msg):
+        self.print_usage(_stream('stderr'))
+        self.exit(2, "%s: error: %s\n" % (self.get_prog_name(), msg))
+
+    def exit(self, status=0, msg=None):
+        if msg:
+            _stream('stderr').write(msg)
+        sys.exit(status)
+
+class _DaemonServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """The dflatd server, which serves each command line on a thread."""
+    daemon_threads = True
+    requests = 0
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Serve a command line sent by bin/dflat. The request is a line of JSON
+    with the arguments and working directory. The response is lines of
+    JSON, either refusing a command that bin/dflat should run itself, or
+    carrying base64 encoded standard output and error followed by the exit
+    status.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        _OUTPUT.stdout = _DaemonStream(self.wfile, 'stdout')
+        _OUTPUT.stderr = _DaemonStream(self.wfile, 'stderr')
+        try:
+            status = self.run(request['argv'], request['cwd'])
+            if status is not None:
+                self.send({'exit': status})
+        except socket.error:
+            # bin/dflat went away
+            pass
+        finally:
+            _OUTPUT.stdout = _OUTPUT.stderr = _OUTPUT.profile = None
+            _OUTPUT.log_file = None
+
+    def run(self, argv, cwd):
+        """Run a command line, returning its exit status."""
+        try:
+            _, args = _option_parser().parse_args(argv)
+            if not args or args[0] not in DAEMON_COMMANDS:
+                self.send({'refused': True})
+                return None
+            self.server.requests += 1
+            main(argv, cwd)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            _OUTPUT.stderr.write("%s\n" % e.code)
+            return 1
+        except socket.error:
+            raise
+        except Exception:
+            _OUTPUT.stderr.write(traceback.format_exc())
+            return 1
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+class _DaemonStream(io.RawIOBase):
+    """
+    A stream that sends what is written to it to bin/dflat, as standard
+    output or error. Text and bytes can both be written to it.
+    """
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not data:
+            return 0
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        encoded = base64.b64encode(data).decode('ascii')
+        self.wfile.write((json.dumps({self.name: encoded}) +
+                          '\n').encode('utf-8'))
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+class _DaemonLog(logging.Handler):
+    """
+    Send what dflatd logs to the log of the Dflat the command that logged it
+    is running on, or to standard error when it isn't running on one.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.files = {}
+        self.setFormatter(logging.Formatter(
+            LOG_FORMAT, '%Y-%m-%dT%H:%M:%S' + _timezone()))
+        self.stderr = logging.StreamHandler()
+        self.stderr.setFormatter(self.formatter)
+
+    def emit(self, record):
+        log_file = getattr(_OUTPUT, 'log_file', None)
+        profile = getattr(_PROFILING, 'profile', None)
+        if profile is not None:
+            # worker threads log for the command that started them
+            log_file = j(profile.home, 'log', 'dflat.log')
+        if log_file is None:
+            self.stderr.emit(record)
+            return
+        log_file = os.path.abspath(log_file)
+        with self.lock:
+            handler = self.files.get(log_file)
+            if handler is None:
+                handler = self.files[log_file] = \
+                    logging.FileHandler(log_file)
+                handler.setFormatter(self.formatter)
+        handler.emit(record)
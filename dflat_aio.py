@@ -0,0 +1,138 @@
+"""
+Coroutine versions of the dflat commands, for calling them from asyncio
+without blocking the event loop. Use them as dflat.aio:
+
+    import dflat
+    delta = await dflat.aio.commit(home, workers=4)
+
+    events = dflat.aio.progress(dflat.aio.commit, home)
+    async for event in events:
+        print(event)
+    delta = events.result
+
+Commands run on a thread pool of CONCURRENCY threads, and hash and copy
+files on pools of their own as many workers wide as they are asked for.
+A command that finds its Dflat locked sleeps on the event loop until the
+lock is free, or until wait seconds have passed if wait is given, rather
+than raising straight away.
+"""
+
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import dflat
+
+# how many dflat commands may run at once
+CONCURRENCY = 4
+
+# longest time to sleep between attempts to lock a Dflat
+LOCK_POLL = 1.0
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+async def init(home, wait=None, progress=None, **opts):
+    """Coroutine version of dflat.init."""
+    return await _run(dflat.init, home, (), opts, wait, progress)
+
+async def checkout(home, wait=None, progress=None, **opts):
+    """Coroutine version of dflat.checkout."""
+    return await _run(dflat.checkout, home, (), opts, wait, progress)
+
+async def commit(home, wait=None, progress=None, **opts):
+    """Coroutine version of dflat.commit, returning its Delta."""
+    return await _run(dflat.commit, home, (), opts, wait, progress)
+
+async def status(home, wait=None, progress=None, **opts):
+    """Coroutine version of dflat.status, returning its Delta."""
+    return await _run(dflat.status, home, (), opts, wait, progress)
+
+async def export(home, version, wait=None, progress=None, **opts):
+    """Coroutine version of dflat.export."""
+    return await _run(dflat.export, home, (version,), opts, wait, progress)
+
+async def verify(home, wait=None, progress=None, **opts):
+    """
+    Coroutine version of dflat.verify, returning its report. A verify that
+    finds a directory locked resumes from its checkpoint once it is free.
+    """
+    return await _run(dflat.verify, home, (), opts, wait, progress)
+
+def progress(command, home, *args, **opts):
+    """
+    Run one of the coroutines in this module as a task, returning an async
+    iterator over its progress events: dictionaries with the command and
+    either the phase that just finished and the seconds it took, the new
+    value of a counter such as digest.bytes or copy.files, or locked when
+    the command is waiting for its Dflat. Iteration stops when the command
+    finishes, leaving what it returned in the iterator's result attribute,
+    or raises the exception it raised.
+    """
+    return _Progress(command, home, args, opts)
+
+class _Progress(object):
+    """Async iterator over the progress events of a running command."""
+
+    def __init__(self, command, home, args, opts):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.result = None
+
+        def listener(event):
+            loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+        self.task = loop.create_task(command(home, *args, progress=listener,
+                                             **opts))
+        self.task.add_done_callback(lambda task: self.queue.put_nowait(None))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is not None:
+            return event
+        # done callbacks run after events sent before the command finished
+        self.result = self.task.result()
+        raise StopAsyncIteration
+
+async def _run(func, home, args, opts, wait=None, listener=None):
+    """
+    Run a dflat command on the thread pool, sleeping on the event loop and
+    trying again for as long as it finds the Dflat locked.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if wait is None else time.time() + wait
+    delay = 0.01
+    while True:
+        try:
+            return await loop.run_in_executor(_executor(), _call, func, home,
+                                              args, opts, listener)
+        except dflat.LockedError:
+            if deadline is not None and time.time() >= deadline:
+                raise
+        if listener:
+            listener({'command': func.__name__, 'locked': True})
+        pause = delay if deadline is None else \
+            max(0, min(delay, deadline - time.time()))
+        await asyncio.sleep(pause)
+        delay = min(delay * 2, LOCK_POLL)
+
+def _call(func, home, args, opts, listener):
+    """Call a dflat command on a pool thread, telling listener its progress."""
+    dflat._PROFILING.listener = listener
+    try:
+        return func(home, *args, wait=0, **opts)
+    finally:
+        dflat._PROFILING.listener = None
+
+def _executor():
+    """Return the thread pool that commands run on, starting it if need be."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(CONCURRENCY,
+                                           thread_name_prefix='dflat-aio')
+        return _EXECUTOR
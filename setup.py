@@ -11,8 +11,9 @@ setup(
     author = "Ed Summers",
     author_email = "ehs@pobox.com",
     url = "http://github.com/edsu/dflat",
-    py_modules = ['dflat', 'ez_setup'],
+    py_modules = ['dflat', 'dflat_aio', 'ez_setup'],
     test_suite = 'test',
-    scripts = ['bin/dflat'],
+    scripts = ['bin/dflat', 'bin/dflatd'],
+    python_requires = '>=3.7',
     install_requires = ['namaste'],
 )
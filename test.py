@@ -1,8 +1,21 @@
+import io
+import errno
+import logging
+import sys
+import subprocess
+import asyncio
 import re
+import json
+import time
+import threading
+import tarfile
+import zipfile
 import unittest
-from os import mkdir, remove
-from os.path import isdir, isfile, islink, basename, realpath
-from shutil import rmtree, copytree
+from os import environ, pathsep, listdir, mkdir, remove, rename, urandom, utime
+from os.path import isdir, isfile, islink, basename, realpath, samefile
+from os.path import getmtime, getsize, join as j
+from shutil import rmtree, copytree, copyfile
+from socket import gethostname
 
 import dflat
 
@@ -66,6 +79,49 @@ class DflatTests(unittest.TestCase):
         self.assertEqual(manifest['producer/namastespec.html'], '7cdea11aa319f3a227a108d871285e84')
         self.assertEqual(manifest['producer/reddspec.html'], 'd3fcc19c54d424d53bcd5621fca34183')
 
+    def test_parallel_manifest(self):
+        dflat.init('dflat-test')
+        with open('dflat-test/v001/manifest.txt') as f:
+            serial = f.read()
+        dflat._update_manifest('dflat-test/v001', workers=4)
+        with open('dflat-test/v001/manifest.txt') as f:
+            self.assertEqual(f.read(), serial)
+        dflat._update_manifest('dflat-test/v001', workers=2, processes=True)
+        with open('dflat-test/v001/manifest.txt') as f:
+            self.assertEqual(f.read(), serial)
+
+    def test_digest_algorithm(self):
+        self.assertRaises(Exception, dflat.init, 'dflat-test', algorithm='crc')
+        dflat.init('dflat-test', algorithm='sha256')
+        with open('dflat-test/v001/manifest.txt') as f:
+            cols = f.readline().split()
+        self.assertEqual(cols[1], 'sha256')
+        self.assertEqual(len(cols[2]), 64)
+
+    def test_migrate(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        dflat.commit(home)
+        dflat.checkout(home)
+        self.assertEqual(dflat.migrate(home, 'blake2b'), [])
+        for manifest in ('v002/manifest.txt', 'v001/d-manifest.txt'):
+            with open(j(home, manifest)) as f:
+                self.assertTrue(all(line.split()[1] == 'blake2b' for line in f))
+        # v001 has no full directory, so its manifest keeps its md5s
+        with open('dflat-test/v001/manifest.txt') as f:
+            self.assertTrue(all(line.split()[1] == 'md5' for line in f))
+        self.assertEqual(dflat._algorithm(home), 'blake2b')
+        self.assertEqual(dflat.verify(home)['mismatched'], [])
+        # deltas between manifests made with different algorithms
+        with open('dflat-test/v003/full/producer/checkmspec.html', 'a') as f:
+            f.write('mod')
+        dflat._set_info(home, 'Digest-algorithm', 'sha1')
+        status = dflat.status(home)
+        self.assertEqual(list(status), [('modified', 'producer/checkmspec.html')])
+
     def test_checkout(self):
         dflat.init('dflat-test')
         dflat.checkout('dflat-test')
@@ -82,6 +138,44 @@ class DflatTests(unittest.TestCase):
         self.assertTrue(isfile('dflat-test/v002/full/producer/namastespec.html'))
         self.assertTrue(isfile('dflat-test/v002/full/producer/reddspec.html'))
 
+    def test_checkout_clone(self):
+        dflat.init('dflat-test')
+        # falls back to copying where extents can't be shared
+        dflat.checkout('dflat-test', clone='reflink')
+        self.assertFalse(samefile('dflat-test/v001/full/producer/reddspec.html',
+                                  'dflat-test/v002/full/producer/reddspec.html'))
+        self.assertFileEqual('dflat-test/v001/full/producer/reddspec.html',
+                             'dflat-test/v002/full/producer/reddspec.html')
+        self.assertFalse(dflat._has_changes(dflat.status('dflat-test')))
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        delta = dflat.commit('dflat-test')
+        self.assertEqual(delta['modified'], ['producer/reddspec.html'])
+        self.assertFileEqual('dflat-test/v001/delta/add/producer/reddspec.html',
+                             'docs/reddspec.html')
+        self.assertRaises(Exception, dflat.checkout, 'dflat-test',
+                          clone='hardlink')
+
+    def test_copy_tree(self):
+        mkdir('dflat-test/a')
+        mkdir('dflat-test/a/b')
+        with open('dflat-test/a/b/c.txt', 'w') as f:
+            f.write('deep')
+        utime('dflat-test/a/b/c.txt', (0, 0))
+        utime('dflat-test/a', (0, 0))
+        copied = dflat._copy_tree('dflat-test', 'dflat-copy', workers=4)
+        try:
+            self.assertEqual(copied['files'], 7)
+            self.assertEqual(copied['bytes'], sum(
+                getsize(j('dflat-test', f)) for f in listdir('dflat-test')
+                if isfile(j('dflat-test', f))) + 4)
+            self.assertFileEqual('dflat-copy/a/b/c.txt', 'dflat-test/a/b/c.txt')
+            self.assertFileEqual('dflat-copy/reddspec.html', 'docs/reddspec.html')
+            self.assertEqual(getmtime('dflat-copy/a/b/c.txt'), 0)
+            self.assertEqual(getmtime('dflat-copy/a'), 0)
+        finally:
+            rmtree('dflat-copy')
+
     def test_commit(self):
         dflat.init('dflat-test')
         dflat.checkout('dflat-test')
@@ -108,6 +202,52 @@ class DflatTests(unittest.TestCase):
         status = dflat.status('dflat-test')
         self.assertTrue('producer/d' in status['added'])
 
+    def test_fixity_cache(self):
+        racy_window = dflat.RACY_WINDOW
+        dflat.RACY_WINDOW = 0
+        try:
+            dflat.init('dflat-test')
+            dflat.checkout('dflat-test')
+            status = dflat.status('dflat-test')
+            self.assertFalse(dflat._has_changes(status))
+            cache_file = 'dflat-test/cache/fixity-v002.txt'
+            self.assertTrue(isfile(cache_file))
+            with open(cache_file) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 7)
+            # a cached digest is trusted while the file's stat is unchanged
+            with open(cache_file, 'w') as f:
+                for line in lines:
+                    if line.startswith('producer/reddspec.html '):
+                        line = line.rsplit(' ', 1)[0] + ' bogus\n'
+                    f.write(line)
+            status = dflat.status('dflat-test')
+            self.assertEqual(status['modified'], ['producer/reddspec.html'])
+            status = dflat.status('dflat-test', paranoid=True)
+            self.assertFalse(dflat._has_changes(status))
+        finally:
+            dflat.RACY_WINDOW = racy_window
+
+    def test_delta_merge(self):
+        dflat.init('dflat-test')
+        with open('dflat-test/v001/manifest.txt') as f:
+            lines = f.readlines()
+        self.assertEqual(lines, sorted(lines))
+        # manifests from older releases weren't sorted
+        with open('dflat-test/v001/manifest.txt', 'w') as f:
+            f.writelines(reversed(lines))
+        dflat.checkout('dflat-test')
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+            f.write('a')
+        remove('dflat-test/v002/full/producer/canspec.pdf')
+        status = dflat.status('dflat-test')
+        self.assertEqual(list(status), [('added', 'producer/a.txt'),
+                                        ('deleted', 'producer/canspec.pdf'),
+                                        ('modified', 'producer/reddspec.html')])
+        self.assertEqual(status['deleted'], ['producer/canspec.pdf'])
+
     def test_locking(self):
         # create named function objects to test user-agent func
         def init(): pass
@@ -151,6 +291,148 @@ class DflatTests(unittest.TestCase):
         dflat._release_lock('dflat-test')
         self.assertFalse(isfile(lockfile))
 
+    def test_stale_lock(self):
+        dflat.init('dflat-test')
+        # a lock left behind by a process on this host that has died
+        with open('dflat-test/lock.txt', 'w') as f:
+            f.write('Lock: 2010-01-01T00:00:00+00:00 dflat-commit@%s:%i\n' %
+                    (gethostname(), 2 ** 22 + 1))
+        dflat.checkout('dflat-test')
+        self.assertTrue(isdir('dflat-test/v002'))
+        self.assertFalse(isfile('dflat-test/lock.txt'))
+        # a lock held by someone else is waited for, then given up on
+        with open('dflat-test/lock.txt', 'w') as f:
+            f.write('Lock: 2010-01-01T00:00:00+00:00 dflat-commit\n')
+        start = time.time()
+        self.assertRaises(Exception, dflat.commit, 'dflat-test', wait=0.2)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertTrue(isfile('dflat-test/lock.txt'))
+        # unless it is older than stale_after
+        utime('dflat-test/lock.txt', (0, 0))
+        self.assertEqual(dflat.status('dflat-test', stale_after=60).counts(),
+                         {'added': 0, 'modified': 0, 'deleted': 0,
+                          'renamed': 0})
+        with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+            f.write('a')
+        dflat.commit('dflat-test', stale_after=60)
+        self.assertEqual(dflat._current_version('dflat-test'), 'v002')
+        self.assertFalse(isfile('dflat-test/lock.txt'))
+        # failing to create lock.txt isn't mistaken for contention
+        create_lockfile = dflat._create_lockfile
+
+        def unwritable(lockfile, caller):
+            raise OSError(errno.EACCES, 'Permission denied', lockfile)
+        dflat._create_lockfile = unwritable
+        try:
+            self.assertRaises(PermissionError, dflat.checkout, 'dflat-test',
+                              wait=1)
+        finally:
+            dflat._create_lockfile = create_lockfile
+        dflat.checkout('dflat-test')
+
+    def test_shared_lock(self):
+        dflat.init('dflat-test')
+        def reader(): pass
+        dflat._get_lock('dflat-test', reader, shared=True)
+        try:
+            # other readers get in, writers don't
+            status = dflat.status('dflat-test')
+            self.assertEqual(status, None)
+            self.assertRaises(Exception, dflat.checkout, 'dflat-test')
+            self.assertFalse(isfile('dflat-test/lock.txt'))
+        finally:
+            dflat._release_lock('dflat-test')
+        dflat.checkout('dflat-test')
+        self.assertTrue(isdir('dflat-test/v002'))
+
+    def test_batch(self):
+        homes = ['dflat-test', 'dflat-test2']
+        copytree('docs', 'dflat-test2')
+        try:
+            for home in homes:
+                dflat.init(home)
+                dflat.checkout(home)
+            with open('dflat-test2/v002/full/producer/new.txt', 'w') as f:
+                f.write('new')
+            results = dict((r['home'], r) for r in
+                           dflat.batch('status', homes + ['dflat-missing'],
+                                       workers=2))
+            self.assertEqual(len(results), 3)
+            self.assertFalse(results['dflat-missing']['ok'])
+            self.assertEqual(results['dflat-test']['result'],
+                             {'added': 0, 'deleted': 0, 'modified': 0,
+                              'renamed': 0})
+            self.assertEqual(results['dflat-test2']['result']['added'], 1)
+            results = list(dflat.batch('commit', homes, workers=2))
+            self.assertTrue(all(r['ok'] for r in results))
+            self.assertEqual(dflat._current_version('dflat-test2'), 'v002')
+            self.assertEqual(dflat._current_version('dflat-test'), 'v001')
+        finally:
+            rmtree('dflat-test2')
+
+    def test_verify(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        dflat.commit(home)
+        report = dflat.verify(home, workers=2)
+        self.assertEqual(report, {'verified': 10, 'mismatched': [],
+                                  'missing': [], 'extra': []})
+        with open('dflat-test/v001/delta/add/producer/reddspec.html', 'a') as f:
+            f.write('rot')
+        remove('dflat-test/v002/full/producer/canspec.pdf')
+        with open('dflat-test/v002/full/producer/stray.txt', 'w') as f:
+            f.write('stray')
+        report = dflat.verify(home, rate=100, iops=1000)
+        self.assertEqual(report['mismatched'],
+                         ['v001/delta/add/producer/reddspec.html'])
+        self.assertEqual(report['missing'], ['v002/full/producer/canspec.pdf'])
+        self.assertEqual(report['extra'], ['v002/full/producer/stray.txt'])
+        self.assertFalse(isfile('dflat-test/log/verify.json'))
+
+    def test_verify_resume(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        # an audit interrupted after checking some of v001
+        with open('dflat-test/log/verify.json', 'w') as f:
+            json.dump({'done': [], 'unit': 'v001/full',
+                       'position': 'producer/clopspec.pdf', 'verified': 4,
+                       'mismatched': ['v001/full/producer/canspec.pdf'],
+                       'missing': [], 'extra': []}, f)
+        report = dflat.verify(home)
+        self.assertEqual(report['verified'], 7)
+        self.assertEqual(report['mismatched'],
+                         ['v001/full/producer/canspec.pdf'])
+        report = dflat.verify(home)
+        self.assertEqual(report['mismatched'], [])
+
+    def test_dedupe(self):
+        home = 'dflat-test'
+        dflat.init(home, dedupe=True)
+        redd = 'full/producer/reddspec.html'
+        # flip reddspec.html between two states
+        for i in range(3):
+            version = dflat.checkout(home)
+            if i % 2 == 0:
+                with open(j(home, version, redd), 'a') as f:
+                    f.write('mod')
+            else:
+                copyfile('docs/reddspec.html', j(home, version, redd))
+            dflat.commit(home)
+        added = 'dflat-test/%s/delta/add/producer/reddspec.html'
+        self.assertTrue(samefile(added % 'v001', added % 'v003'))
+        self.assertFalse(samefile(added % 'v001', added % 'v002'))
+        self.assertEqual(len(listdir('dflat-test/objects/md5')), 2)
+        dflat.export(home, 'v003')
+        self.assertFileEqual('dflat-test/export-v003/full/producer/reddspec.html',
+                             'docs/reddspec.html')
+        self.assertEqual(dflat.gc(home), {'blobs': 0, 'bytes': 0})
+        remove(added % 'v002')
+        self.assertEqual(dflat.gc(home)['blobs'], 1)
+        self.assertEqual(len(listdir('dflat-test/objects/md5')), 1)
+
     def test_export(self):
         home = 'dflat-test'
         dflat.init(home)
@@ -208,5 +490,659 @@ class DflatTests(unittest.TestCase):
             with open('dflat-test/v005/full/producer/reddspec.html') as f8:
                 self.assertNotEqual(f7.read(), f8.read())
         
+    def test_export_plan(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        for i in range(3):
+            version = dflat.checkout(home)
+            with open(j(home, version, 'full/producer/reddspec.html'), 'a') as f:
+                f.write('mod %i' % i)
+            dflat.commit(home)
+        plan = dflat._export_plan(home, 'v001')
+        self.assertEqual(plan['producer/reddspec.html'],
+                         'v001/delta/add/producer/reddspec.html')
+        self.assertEqual(plan['producer/dflatspec.pdf'],
+                         'v004/full/producer/dflatspec.pdf')
+        self.assertEqual(sorted(plan), sorted(dflat._manifest_dict(home, 'v001')))
+        dflat.export(home, 'v002')
+        self.assertFileEqual('dflat-test/export-v002/manifest.txt',
+                             'dflat-test/v002/manifest.txt')
+        with open('dflat-test/export-v002/full/producer/reddspec.html') as f:
+            self.assertTrue(f.read().endswith('mod 0'))
+
+    def test_keyframes(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.compact(home, interval=2)
+        for i in range(3):
+            version = dflat.checkout(home)
+            with open(j(home, version, 'full/producer/reddspec.html'), 'a') as f:
+                f.write('mod %i' % i)
+            dflat.commit(home)
+        self.assertTrue(isdir('dflat-test/v002/full'))
+        self.assertTrue(isdir('dflat-test/v002/delta'))
+        self.assertFalse(isdir('dflat-test/v001/full'))
+        self.assertFalse(isdir('dflat-test/v003/full'))
+        plan = dflat._export_plan(home, 'v002')
+        self.assertEqual(plan['producer/dflatspec.pdf'],
+                         'v002/full/producer/dflatspec.pdf')
+        with open('dflat-test/v002/full/producer/reddspec.html') as f:
+            self.assertTrue(f.read().endswith('mod 0'))
+        # dropping the policy removes the keyframe, and restoring it
+        # rebuilds the keyframe from the deltas
+        self.assertEqual(dflat.compact(home, interval=0), [])
+        self.assertFalse(isdir('dflat-test/v002/full'))
+        self.assertEqual(dflat.compact(home, interval=2), ['v002'])
+        self.assertTrue(isfile('dflat-test/v002/full/producer/dflatspec.pdf'))
+        with open('dflat-test/v002/full/producer/reddspec.html') as f:
+            self.assertTrue(f.read().endswith('mod 0'))
+        dflat.export(home, 'v001')
+        with open('dflat-test/export-v001/full/producer/reddspec.html') as f1:
+            with open('docs/reddspec.html') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_keyframe_bytes(self):
+        home = 'dflat-test'
+        dflat.init(home, patch_threshold=4096)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/big.bin', 'wb') as f:
+            f.write(urandom(200000))
+        dflat.commit(home)
+        dflat.compact(home, max_bytes=20000)
+        for i in range(4):
+            version = dflat.checkout(home)
+            with open(j(home, version, 'full/big.bin'), 'r+b') as f:
+                f.seek(i * 40000)
+                f.write(urandom(20000))
+            dflat.commit(home)
+        self.assertTrue(isdir('dflat-test/v003/delta/patch'))
+        keyframes = [v for v in ('v002', 'v003', 'v004', 'v005')
+                     if isdir(j(home, v, 'full'))]
+        self.assertEqual(keyframes, ['v002', 'v003', 'v004', 'v005'])
+        # compact counts patches the same way commit does
+        self.assertEqual(dflat.compact(home), keyframes)
+        self.assertEqual([v for v in ('v002', 'v003', 'v004', 'v005')
+                          if isdir(j(home, v, 'full'))], keyframes)
+
+    def test_keyframe_emptied_dir(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        mkdir('dflat-test/v002/full/producer/sub')
+        with open('dflat-test/v002/full/producer/sub/only.txt', 'w') as f:
+            f.write('only')
+        dflat.commit(home)
+        dflat.compact(home, interval=1)
+        dflat.checkout(home)
+        with open('dflat-test/v003/full/producer/sub/only.txt', 'a') as f:
+            f.write(' mod')
+        dflat.commit(home)
+        with open('dflat-test/v002/full/producer/sub/only.txt') as f:
+            self.assertEqual(f.read(), 'only')
+        dflat.checkout(home)
+        remove('dflat-test/v004/full/producer/sub/only.txt')
+        dflat.commit(home)
+        with open('dflat-test/v003/full/producer/sub/only.txt') as f:
+            self.assertEqual(f.read(), 'only mod')
+        self.assertEqual(dflat.recover(home), None)
+        dflat.export(home, 'v002')
+        self.assertFileEqual('dflat-test/export-v002/manifest.txt',
+                             'dflat-test/v002/manifest.txt')
+
+    def test_open_at(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        remove('dflat-test/v002/full/producer/dflatspec.pdf')
+        dflat.commit(home)
+        with dflat.open_at(home, 'v001', 'producer/reddspec.html') as f:
+            with open('docs/reddspec.html', 'rb') as original:
+                self.assertEqual(f.read(), original.read())
+        with dflat.open_at(home, 'v002', 'producer/reddspec.html') as f:
+            self.assertTrue(f.read().endswith(b'mod'))
+        self.assertRaises(Exception, dflat.open_at, home, 'v002',
+                          'producer/dflatspec.pdf')
+        self.assertRaises(Exception, dflat.open_at, home, 'v009',
+                          'producer/reddspec.html')
+        got = dflat.get(home, 'v001', 'producer/*.pdf', dest='dflat-get')
+        try:
+            self.assertEqual(got, ['producer/canspec.pdf',
+                                   'producer/clopspec.pdf',
+                                   'producer/dflatspec.pdf'])
+            self.assertTrue(isfile('dflat-get/producer/dflatspec.pdf'))
+            self.assertFalse(isfile('dflat-get/producer/reddspec.html'))
+        finally:
+            rmtree('dflat-get')
+
+    def test_export_archive(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        dflat.commit(home)
+        dflat.export(home, 'v001', output='dflat-test.tar', format='tar')
+        try:
+            self.assertFalse(isdir('dflat-test/export-v001'))
+            with tarfile.open('dflat-test.tar') as archive:
+                names = archive.getnames()
+                self.assertTrue('export-v001/manifest.txt' in names)
+                self.assertEqual(len(names), 8)
+                f = archive.extractfile('export-v001/full/producer/reddspec.html')
+                with open('docs/reddspec.html', 'rb') as original:
+                    self.assertEqual(f.read(), original.read())
+        finally:
+            remove('dflat-test.tar')
+        out = io.BytesIO()
+        dflat.export(home, 'v002', output=out, format='zip')
+        with zipfile.ZipFile(io.BytesIO(out.getvalue())) as archive:
+            data = archive.read('export-v002/full/producer/reddspec.html')
+            self.assertTrue(data.endswith(b'mod'))
+
+    def test_patch(self):
+        base = urandom(200000)
+        target = base[:50000] + b'inserted' + base[50000:] + b'appended'
+        for name, data in (('patch-base', base), ('patch-target', target)):
+            with open(name, 'wb') as f:
+                f.write(data)
+        try:
+            self.assertTrue(dflat._make_patch('patch-target', 'patch-base',
+                                              'patch-file'))
+            self.assertTrue(getsize('patch-file') < 20000)
+            source = ('patch-file', 'patch-base')
+            with dflat._open_source(source) as f:
+                self.assertEqual(f.read(), target)
+                f.seek(49990)
+                self.assertEqual(f.read(20), target[49990:50010])
+            self.assertFalse(dflat._make_patch('patch-target', 'patch-file',
+                                               'patch-other'))
+            self.assertFalse(isfile('patch-other'))
+        finally:
+            for name in ('patch-base', 'patch-target', 'patch-file'):
+                remove(name)
+
+    def test_commit_patch(self):
+        home = 'dflat-test'
+        dflat.init(home, patch_threshold=1)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        dflat.commit(home)
+        patch = 'dflat-test/v001/delta/patch/producer/reddspec.html'
+        self.assertTrue(isfile(patch))
+        self.assertFalse(isfile('dflat-test/v001/delta/add/producer/reddspec.html'))
+        with open('dflat-test/v001/d-manifest.txt') as f:
+            self.assertTrue('patch/producer/reddspec.html' in f.read())
+        with open('docs/reddspec.html', 'rb') as original:
+            data = original.read()
+        with dflat.open_at(home, 'v001', 'producer/reddspec.html') as f:
+            self.assertEqual(f.read(), data)
+        dflat.export(home, 'v001')
+        self.assertFileEqual('dflat-test/export-v001/full/producer/reddspec.html',
+                             'docs/reddspec.html')
+        out = io.BytesIO()
+        dflat.export(home, 'v001', output=out, format='tar')
+        with tarfile.open(fileobj=io.BytesIO(out.getvalue())) as archive:
+            f = archive.extractfile('export-v001/full/producer/reddspec.html')
+            self.assertEqual(f.read(), data)
+
+    def test_delta_one_pass(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+            f.write('a')
+        merges = []
+        merge = dflat._delta_merge
+
+        def counted(*args):
+            merges.append(args)
+            return merge(*args)
+
+        dflat._delta_merge = counted
+        try:
+            delta = dflat.status(home)
+            self.assertEqual(delta.counts()['added'], 1)
+            self.assertEqual(len(merges), 1)
+            delta = dflat.commit(home)
+            self.assertEqual(delta.counts()['added'], 1)
+            self.assertEqual(len(merges), 2)
+        finally:
+            dflat._delta_merge = merge
+
+    def test_rename(self):
+        home = 'dflat-test'
+        dflat.init(home, detect_renames=True)
+        dflat.checkout(home)
+        rename('dflat-test/v002/full/producer',
+           'dflat-test/v002/full/moved')
+        with open('dflat-test/v002/full/moved/reddspec.html', 'a') as f:
+            f.write('mod')
+        delta = dflat.status(home)
+        self.assertEqual(delta['deleted'], ['producer/reddspec.html'])
+        self.assertEqual(delta['added'], ['moved/reddspec.html'])
+        self.assertTrue(('producer/canspec.pdf', 'moved/canspec.pdf')
+                        in list(delta.renames()))
+        self.assertEqual(delta.counts()['renamed'], 5)
+        dflat.commit(home)
+        self.assertEqual(listdir('dflat-test/v001/delta/add/producer'),
+                         ['reddspec.html'])
+        with open('dflat-test/v001/delta/rename.txt') as f:
+            self.assertTrue('moved/canspec.pdf producer/canspec.pdf\n'
+                            in f.readlines())
+        dflat.export(home, 'v001')
+        for filename in listdir('docs'):
+            self.assertTrue(isfile(j('dflat-test/export-v001/full/producer',
+                                     filename)))
+        self.assertFileEqual('dflat-test/export-v001/full/producer/'
+                             'checkmspec.html', 'docs/checkmspec.html')
+        with dflat.open_at(home, 'v001', 'producer/namastespec.html') as f:
+            with open('docs/namastespec.html', 'rb') as original:
+                self.assertEqual(f.read(), original.read())
+
+    def test_rename_plain(self):
+        # without rename detection deltas stay plain ReDD
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        rename('dflat-test/v002/full/producer/canspec.pdf',
+               'dflat-test/v002/full/producer/moved.pdf')
+        delta = dflat.commit(home)
+        self.assertEqual(delta.counts()['renamed'], 0)
+        self.assertFalse(isfile('dflat-test/v001/delta/rename.txt'))
+        self.assertTrue(isfile('dflat-test/v001/delta/add/producer/'
+                               'canspec.pdf'))
+        with open('dflat-test/v001/delta/delete.txt') as f:
+            self.assertEqual(f.read(), 'producer/moved.pdf\n')
+
+    def test_index(self):
+        home = 'dflat-test'
+        dflat.init(home, index=True, detect_renames=True)
+        self.assertTrue(isfile('dflat-test/index.sqlite'))
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        rename('dflat-test/v002/full/producer/canspec.pdf',
+               'dflat-test/v002/full/producer/moved.pdf')
+        dflat.commit(home)
+        dflat.checkout(home)
+        remove('dflat-test/v003/full/producer/reddspec.html')
+        dflat.commit(home)
+        rows = dflat.history(home, 'producer/reddspec.html')
+        self.assertEqual([row[0] for row in rows], ['v001', 'v002'])
+        self.assertEqual(rows[0][1], getsize('docs/reddspec.html'))
+        self.assertNotEqual(rows[0][3], rows[1][3])
+        digest = dflat._manifest_dict(home, 'v001')['producer/canspec.pdf'][1]
+        found = dflat.find(home, digest)
+        self.assertEqual([row[:2] for row in found],
+                         [('v001', 'producer/canspec.pdf'),
+                          ('v002', 'producer/moved.pdf'),
+                          ('v003', 'producer/moved.pdf')])
+        self.assertEqual(found[0][2], 'v003/full/producer/moved.pdf')
+        dflat.export(home, 'v001')
+        self.assertFileEqual('dflat-test/export-v001/full/producer/'
+                             'reddspec.html', 'docs/reddspec.html')
+        self.assertEqual(getsize('dflat-test/export-v001/full/producer/'
+                                 'canspec.pdf'), getsize('docs/canspec.pdf'))
+        # the index is rebuilt from the manifests and deltas when it's lost
+        remove('dflat-test/index.sqlite')
+        self.assertEqual(dflat.index(home), {'versions': 3, 'files': 20})
+        self.assertEqual(dflat.find(home, digest), found)
+
+        # fixity checks read the manifests, not the index
+        with open('dflat-test/v003/manifest.txt') as f:
+            lines = f.readlines()
+        with open('dflat-test/v003/manifest.txt', 'w') as f:
+            for line in lines:
+                if 'checkmspec.html' in line:
+                    continue
+                if 'clopspec.pdf' in line:
+                    line = line.rsplit(' ', 1)[0] + ' 0\n'
+                f.write(line)
+        report = dflat.verify(home)
+        self.assertEqual(report['mismatched'],
+                         ['v003/full/producer/clopspec.pdf'])
+        self.assertEqual(report['extra'],
+                         ['v003/full/producer/checkmspec.html'])
+
+    def test_index_migrate(self):
+        home = 'dflat-test'
+        dflat.init(home, index=True)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+            f.write('mod')
+        dflat.commit(home)
+        self.assertEqual(dflat.migrate(home, 'sha256'), [])
+        # v001 keeps its md5s, so the files it shares with v002 can't be
+        # found by digest
+        dflat.export(home, 'v001')
+        self.assertFileEqual('dflat-test/export-v001/full/producer/'
+                             'reddspec.html', 'docs/reddspec.html')
+        self.assertEqual(getsize('dflat-test/export-v001/full/producer/'
+                                 'dflatspec.pdf'),
+                         getsize('docs/dflatspec.pdf'))
+        with dflat.open_at(home, 'v001', 'producer/canspec.pdf') as f:
+            with open('docs/canspec.pdf', 'rb') as original:
+                self.assertEqual(f.read(), original.read())
+
+    def test_watch(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        watcher = threading.Thread(target=dflat.watch, args=(home,),
+                                   kwargs={'timeout': 3})
+        watcher.start()
+        try:
+            while not isfile('dflat-test/cache/journal-v002.txt'):
+                time.sleep(0.01)
+            # the first status scans everything and starts using the journal
+            self.assertEqual(dflat._journal_sync('dflat-test/v002')[2], None)
+            self.assertFalse(dflat._has_changes(dflat.status(home)))
+            with open('dflat-test/v002/full/producer/reddspec.html', 'a') as f:
+                f.write('mod')
+            mkdir('dflat-test/v002/full/producer/new')
+            with open('dflat-test/v002/full/producer/new/a.txt', 'w') as f:
+                f.write('a')
+            remove('dflat-test/v002/full/producer/canspec.pdf')
+            # files in new directories may be journaled by directory
+            changes = dflat._journal_sync('dflat-test/v002')[2]
+            self.assertTrue(set(['producer/reddspec.html', 'producer/new',
+                                 'producer/canspec.pdf']) <= changes)
+            delta = dflat.status(home)
+            self.assertEqual(delta['modified'], ['producer/reddspec.html'])
+            self.assertEqual(delta['added'], ['producer/new/a.txt'])
+            self.assertEqual(delta['deleted'], ['producer/canspec.pdf'])
+            self.assertEqual(dflat._journal_sync('dflat-test/v002')[2], set())
+            dflat.commit(home)
+            while isfile('dflat-test/cache/journal-v002.txt'):
+                time.sleep(0.01)
+        finally:
+            watcher.join()
+        self.assertFalse(isfile('dflat-test/cache/watch.txt'))
+
+    def test_profile(self):
+        records = []
+        dflat.add_profile_hook(records.append)
+        try:
+            dflat.init('dflat-test')
+            dflat.checkout('dflat-test')
+            with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+                f.write('a')
+            with self.assertLogs(level='INFO') as logs:
+                dflat.commit('dflat-test')
+        finally:
+            dflat.remove_profile_hook(records.append)
+        self.assertEqual([r['command'] for r in records],
+                         ['checkout', 'commit'])
+        commit = records[1]
+        for phase in ('lock', 'manifest.hash', 'delta', 'commit.plan',
+                      'commit.store', 'commit.trash'):
+            self.assertTrue(phase in commit['phases'], phase)
+        self.assertEqual(commit['counters']['commit.added'], 1)
+        self.assertTrue(commit['counters']['digest.files'] > 0)
+        self.assertEqual(records[0]['counters']['copy.files'], 7)
+        logged = [json.loads(r.args[0]) for r in logs.records
+                  if r.msg == 'profile %s']
+        self.assertEqual(logged, [commit])
+
+    def test_recover(self):
+        home = 'dflat-test'
+        dflat.init(home)
+
+        def crash(*args, **kwargs):
+            raise KeyboardInterrupt()
+
+        def interrupted_commit(step, deleted):
+            dflat.checkout(home)
+            version = dflat._latest_version(home)
+            with open(j(home, version, 'full/producer/reddspec.html'),
+                      'a') as f:
+                f.write(version)
+            remove(j(home, version, 'full/producer', deleted))
+            original = getattr(dflat, step)
+            setattr(dflat, step, crash)
+            try:
+                self.assertRaises(KeyboardInterrupt, dflat.commit, home)
+            finally:
+                setattr(dflat, step, original)
+            self.assertTrue(isfile('dflat-test/log/commit.jsonl'))
+            self.assertRaises(Exception, dflat.status, home)
+
+        # interrupted while planning: nothing has moved, so roll back
+        interrupted_commit('_keyframe_due', 'canspec.pdf')
+        self.assertEqual(dflat.recover(home), 'back')
+        self.assertFalse(isdir('dflat-test/v001/delta'))
+        self.assertTrue(isfile('dflat-test/v001/full/producer/canspec.pdf'))
+        self.assertEqual(dflat._current_version(home), 'v001')
+        dflat.commit(home)
+
+        # interrupted after moving files: roll forward
+        interrupted_commit('_set_current', 'clopspec.pdf')
+        self.assertFalse(isdir('dflat-test/v002/full'))
+        self.assertEqual(dflat._current_version(home), 'v002')
+        self.assertEqual(dflat.recover(home), 'forward')
+        self.assertEqual(dflat._current_version(home), 'v003')
+        self.assertFalse(isfile('dflat-test/log/commit.jsonl'))
+        self.assertEqual(dflat.recover(home), None)
+        report = dflat.verify(home)
+        self.assertEqual(report['mismatched'], [])
+        self.assertEqual(report['missing'], [])
+        dflat.export(home, 'v002')
+        with open('dflat-test/export-v002/full/producer/reddspec.html') as f:
+            self.assertTrue(f.read().endswith('v002'))
+        self.assertTrue(isfile('dflat-test/export-v002/full/producer/'
+                               'clopspec.pdf'))
+        self.assertFalse(isfile('dflat-test/export-v002/full/producer/'
+                                'canspec.pdf'))
+
+        # commands that take the lock recover on their own
+        interrupted_commit('_set_current', 'dflatspec.pdf')
+        dflat.checkout(home)
+        self.assertEqual(dflat._current_version(home), 'v004')
+
+    def test_recover_killed(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        remove('dflat-test/v002/full/producer/canspec.pdf')
+        # the process dies without unwinding while the commit is planned
+        script = ("import os, dflat\n"
+                  "dflat._keyframe_due = lambda *args: os._exit(1)\n"
+                  "dflat.commit(%r)\n" % home)
+        env = dict(environ, PYTHONPATH=pathsep.join(sys.path))
+        result = subprocess.run([sys.executable, '-c', script], env=env)
+        self.assertEqual(result.returncode, 1)
+        self.assertTrue(isdir('dflat-test/v001/delta'))
+        self.assertEqual(dflat.recover(home), 'back')
+        self.assertFalse(isdir('dflat-test/v001/delta'))
+        self.assertFalse(isfile('dflat-test/log/commit.jsonl'))
+        dflat.commit(home)
+        self.assertEqual(dflat._current_version(home), 'v002')
+        self.assertTrue(isfile('dflat-test/v001/delta/add/producer/'
+                               'canspec.pdf'))
+
+        # a journal left empty is rolled back too
+        dflat.checkout(home)
+        mkdir('dflat-test/v002/delta')
+        open('dflat-test/log/commit.jsonl', 'w').close()
+        self.assertEqual(dflat.recover(home), 'back')
+        self.assertFalse(isdir('dflat-test/v002/delta'))
+
+    def test_reap(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+            f.write('a')
+        dflat.commit(home)
+        self.assertFalse(isdir('dflat-test/v001/full'))
+        trash = listdir('dflat-test/trash')
+        self.assertEqual(len(trash), 1)
+        self.assertTrue(trash[0].startswith('v001-full.'))
+        self.assertTrue(isfile(j('dflat-test/trash', trash[0],
+                                 'producer/reddspec.html')))
+        # 6 files and 2 directories, and the directory itself, deleted at
+        # the rate set for the dflat
+        self.assertEqual(dflat._reap_iops(home), dflat.REAP_IOPS)
+        dflat._set_info(home, 'Reap-iops', 40)
+        start = time.time()
+        self.assertEqual(dflat.reap(home), 9)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(listdir('dflat-test/trash'), [])
+        self.assertEqual(dflat.reap(home), 0)
+        dflat.export(home, 'v001')
+        self.assertTrue(isfile('dflat-test/export-v001/full/producer/'
+                               'reddspec.html'))
+
+        dflat.checkout(home)
+        remove('dflat-test/v003/full/producer/a.txt')
+        dflat.commit(home)
+        self.assertEqual(len(listdir('dflat-test/trash')), 1)
+        dflat._reap_in_background(home)
+        for i in range(100):
+            if not listdir('dflat-test/trash'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(listdir('dflat-test/trash'), [])
+
+    def test_aio(self):
+        home = 'dflat-test'
+
+        async def run():
+            await dflat.aio.init(home)
+            await dflat.aio.checkout(home, workers=2)
+            with open('dflat-test/v002/full/producer/a.txt', 'w') as f:
+                f.write('a')
+
+            # a locked dflat is waited for rather than reported
+            dflat._get_lock(home, dflat.commit)
+            asyncio.get_running_loop().call_later(0.2, dflat._release_lock,
+                                                  home)
+            events = dflat.aio.progress(dflat.aio.commit, home)
+            received = [event async for event in events]
+            self.assertEqual(events.result.counts()['added'], 1)
+            self.assertTrue({'command': 'commit', 'locked': True}
+                            in received)
+            self.assertTrue('commit.store' in
+                            [e.get('phase') for e in received])
+            self.assertTrue({'command': 'commit', 'counter': 'commit.added',
+                             'value': 1} in received)
+
+            dflat._get_lock(home, dflat.commit)
+            try:
+                with self.assertRaises(dflat.LockedError):
+                    await dflat.aio.status(home, wait=0.1)
+            finally:
+                dflat._release_lock(home)
+            exports = [dflat.aio.export(home, v) for v in ('v001', 'v002')]
+            await asyncio.gather(*exports)
+            report = await dflat.aio.verify(home)
+            self.assertEqual(report['mismatched'], [])
+
+        asyncio.run(run())
+        self.assertTrue(isfile('dflat-test/export-v002/full/producer/a.txt'))
+        self.assertFalse(isfile('dflat-test/export-v001/full/producer/'
+                                'a.txt'))
+
+    def test_daemon(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        socket_path = realpath('dflat-test.sock')
+        server = dflat._daemon(socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        env = dict(environ, DFLATD_SOCKET=socket_path,
+                   PYTHONPATH=pathsep.join(sys.path))
+        script = realpath('bin/dflat')
+
+        def run(*argv):
+            return subprocess.run([sys.executable, script] + list(argv),
+                                  cwd=j(home, 'v001', 'full'), env=env,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+
+        try:
+            result = run('cat', 'v001', 'producer/reddspec.html')
+            self.assertEqual(result.returncode, 0)
+            with open('dflat-test/v001/full/producer/reddspec.html',
+                      'rb') as f:
+                self.assertEqual(result.stdout, f.read())
+            self.assertEqual(server.requests, 1)
+
+            result = run('log', 'producer/reddspec.html')
+            self.assertTrue(result.stdout.startswith(b'v001 added '))
+            result = run('find')
+            self.assertEqual(result.returncode, 2)
+            self.assertTrue(b'find needs --digest' in result.stderr)
+            result = run('cat', 'v009', 'producer/reddspec.html')
+            self.assertEqual(result.returncode, 1)
+            self.assertTrue(b'Traceback' in result.stderr)
+            self.assertEqual(server.requests, 4)
+
+            # commands that change the dflat are run by bin/dflat itself
+            result = run('checkout')
+            self.assertEqual(result.stdout, b'checked out v002\n')
+            self.assertEqual(server.requests, 4)
+            self.assertEqual(dflat._versions(home), ['v001', 'v002'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            remove(socket_path)
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                if isinstance(handler, dflat._DaemonLog):
+                    root.removeHandler(handler)
+                    for log_file in handler.files.values():
+                        log_file.close()
+
+    def test_cache(self):
+        home = 'dflat-test'
+        dflat.init(home)
+        dflat.checkout(home)
+        # files modified in the racy window aren't cached
+        for filename in ('dflat-test', 'dflat-test/current.txt',
+                         'dflat-test/v001/manifest.txt'):
+            utime(filename, (0, 0))
+        try:
+            manifest = dflat._manifest_dict(home, 'v001')
+            self.assertEqual(dflat._versions(home), ['v001', 'v002'])
+            self.assertEqual(dflat._current_version(home), 'v001')
+            before = dflat.cache_stats()
+            self.assertEqual(dflat._manifest_dict(home, 'v001'), manifest)
+            self.assertEqual(dflat._latest_version(home), 'v002')
+            self.assertEqual(dflat._current_version(home), 'v001')
+            after = dflat.cache_stats()
+            self.assertEqual(after['hits'] - before['hits'], 3)
+            self.assertEqual(after['misses'], before['misses'])
+
+            # changes are seen straight away
+            with open('dflat-test/v001/manifest.txt', 'a') as f:
+                f.write('extra md5 0\n')
+            self.assertEqual(dflat._manifest_dict(home, 'v001')['extra'],
+                             ('md5', '0'))
+            dflat._set_current(home, 'v002')
+            self.assertEqual(dflat._current_version(home), 'v002')
+
+            # manifests that don't fit are streamed rather than cached
+            manifest = 'dflat-test/v001/manifest.txt'
+            utime(manifest, (0, 0))
+            dflat.set_cache_size(getsize(manifest) + 100)
+            entries = dflat._manifest_entries(home, 'v001')
+            self.assertFalse(isinstance(entries, list))
+            self.assertEqual(dict((f, (a, d)) for f, a, d in entries),
+                             dflat._manifest_dict(home, 'v001'))
+            self.assertFalse(manifest in dflat._CACHE.entries)
+
+            dflat.set_cache_size(1)
+            stats = dflat.cache_stats()
+            self.assertEqual(stats['max_bytes'], 1)
+            self.assertTrue(stats['evictions'] > after['evictions'])
+            self.assertEqual(stats['bytes'], 0)
+        finally:
+            dflat.set_cache_size(dflat.CACHE_BYTES)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file